@@ -9,6 +9,16 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from config import Config
+from app.thread_views import ThreadViewBuffer
+from app.presence import PresenceTracker
+from app.reaction_cache import ReactionCache
+from app.sql_profiler import SQLProfiler
+from app.metrics import Metrics
+from app.fragment_cache import FragmentCache
+from app.emoji_index import EmojiIndex
+from app.emoji_sprites import EmojiSprites
+from app.search_outbox import SearchOutboxFlusher
+from app.search_cache import SearchResultCache
 from elasticsearch import Elasticsearch
 
 db = SQLAlchemy()
@@ -19,6 +29,16 @@ login.login_message = 'Please log in to access this page.'
 mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
+thread_views = ThreadViewBuffer()
+presence = PresenceTracker()
+reaction_cache = ReactionCache()
+sql_profiler = SQLProfiler()
+request_metrics = Metrics()
+fragment_cache = FragmentCache()
+emoji_index = EmojiIndex()
+emoji_sprites = EmojiSprites()
+search_outbox = SearchOutboxFlusher()
+search_cache = SearchResultCache()
 
 
 def create_app(config_class=Config):
@@ -31,6 +51,16 @@ def create_app(config_class=Config):
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
+    thread_views.init_app(app)
+    presence.init_app(app)
+    reaction_cache.init_app(app)
+    sql_profiler.init_app(app)
+    request_metrics.init_app(app)
+    fragment_cache.init_app(app)
+    emoji_index.init_app(app)
+    emoji_sprites.init_app(app)
+    search_outbox.init_app(app)
+    search_cache.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -73,6 +103,8 @@ def create_app(config_class=Config):
         
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    from app.search import make_backend
+    app.search_backend = make_backend(app)
 
     return app
 
@@ -0,0 +1,307 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import click
+from flask import current_app
+from sqlalchemy import bindparam, or_
+from app import db, fragment_cache, reaction_cache, emoji_sprites, image_store, search_outbox
+from app.emoji_upload import static_path
+from app.search import reset_index
+from app.models import Post, EditHistory, Thread, Emoji, User, SearchableMixin, small_emoji_images
+from app.static.avatars import random_avatar
+from app.static.markup import melon_markup
+
+markup_tables = {'post': Post, 'edit_history': EditHistory}
+
+
+# the settings url_for builds urls from, handed to each render process
+URL_CONFIG_KEYS = ('SERVER_NAME', 'APPLICATION_ROOT', 'PREFERRED_URL_SCHEME')
+
+
+def init_render_worker(url_config):
+    # tags like [quote,post_id=1] build their links with url_for, which needs a request context. Only the routes are
+    # needed for that, not create_app with its logging and extensions
+    from flask import Flask
+    from app.main import bp as main_bp
+    app = Flask('app')
+    app.config.update(url_config)
+    app.register_blueprint(main_bp)
+    app.test_request_context().push()
+
+
+def render_body(body):
+    return melon_markup.parse(body or "")
+
+
+def rerender_table(model, pool, chunk_size, start_id, rerender_all):
+    """re-render body_formatted for every stale row of model, in id order, one batched UPDATE per chunk"""
+    query = db.session.query(model.id, model.body)
+    if not rerender_all:
+        query = query.filter(or_(model.markup_version.is_(None), model.markup_version != melon_markup.VERSION))
+    total = query.filter(model.id > start_id).count()
+    name = model.__tablename__
+    if total == 0:
+        click.echo('{}: nothing to re-render'.format(name))
+        return
+
+    table = model.__table__
+    values = {'body_formatted': bindparam('formatted'), 'markup_version': melon_markup.VERSION}
+    if 'version' in table.c:
+        # so that cached fragments of the post are rendered again
+        values['version'] = db.func.coalesce(table.c.version, 0) + 1
+    update = table.update().where(table.c.id == bindparam('row_id')).values(**values)
+
+    done = 0
+    last_id = start_id
+    started = time.time()
+    while True:
+        rows = query.filter(model.id > last_id).order_by(model.id.asc()).limit(chunk_size).all()
+        if not rows:
+            break
+        bodies = [row.body for row in rows]
+        if pool:
+            formatted = list(pool.map(render_body, bodies, chunksize=max(1, len(bodies) // 32)))
+        else:
+            with current_app.test_request_context():
+                formatted = [render_body(body) for body in bodies]
+
+        db.session.execute(update, [{'row_id': row.id, 'formatted': f} for row, f in zip(rows, formatted)])
+        db.session.commit()
+
+        done += len(rows)
+        last_id = rows[-1].id
+        elapsed = time.time() - started
+        click.echo('{}: {}/{} rows, last id {}, {:.0f} rows/s'.format(
+            name, done, total, last_id, done / elapsed if elapsed else done))
+
+
+def renumber_posts(start_id, chunk_size):
+    """assign Post.seq for a chunk of threads at a time, in thread id order"""
+    post = Post.__table__
+    update = post.update().where(post.c.id == bindparam('post_id')).values(seq=bindparam('new_seq'))
+    total = Thread.query.filter(Thread.id > start_id).count()
+    done = 0
+    last_id = start_id
+    started = time.time()
+    while True:
+        thread_ids = [row.id for row in db.session.query(Thread.id).filter(Thread.id > last_id).order_by(
+            Thread.id.asc()).limit(chunk_size)]
+        if not thread_ids:
+            break
+        seq = db.func.row_number().over(partition_by=Post.thread_id, order_by=(Post.timestamp.asc(), Post.id.asc()))
+        rows = db.session.query(Post.id, seq).filter(Post.thread_id.in_(thread_ids)).all()
+        if rows:
+            db.session.execute(update, [{'post_id': post_id, 'new_seq': n} for post_id, n in rows])
+        db.session.commit()
+
+        done += len(thread_ids)
+        last_id = thread_ids[-1]
+        elapsed = time.time() - started
+        click.echo('{}/{} threads, {} posts, last id {}, {:.0f} threads/s'.format(
+            done, total, len(rows), last_id, done / elapsed if elapsed else done))
+
+
+def resize_emojis(workers, resize_all):
+    """remake the small versions of emojis, by default only those without a WebP one"""
+    query = Emoji.query.filter(Emoji.file_path.isnot(None))
+    if not resize_all:
+        query = query.filter(Emoji.small_webp_path.is_(None))
+    emojis = query.all()
+    static_dir = os.path.join(current_app.root_path, 'static')
+
+    def resize(emoji):
+        try:
+            return small_emoji_images(os.path.join(static_dir, emoji.file_path))
+        except (OSError, ValueError) as e:
+            click.echo('{}: {}'.format(emoji.name, e))
+            return None
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for emoji, paths in zip(emojis, pool.map(resize, emojis)):
+            if paths is None:
+                continue
+            small_path, webp_path = (static_path(path, static_dir) if path else None for path in paths)
+            emoji.small_path = small_path
+            emoji.small_webp_path = webp_path
+            done += 1
+    db.session.commit()
+    reaction_cache.clear()
+    emoji_sprites.rebuild()
+    click.echo('resized {} of {} emojis'.format(done, len(emojis)))
+
+
+def store_emojis():
+    """move emojis uploaded before the image store into it"""
+    static_dir = os.path.join(current_app.root_path, 'static')
+    store_dir = static_path(current_app.config['IMAGE_STORE_FOLDER'], static_dir) + '/'
+    emojis = Emoji.query.filter(Emoji.file_path.isnot(None), ~Emoji.file_path.startswith(store_dir)).all()
+    moved = 0
+    for emoji in emojis:
+        try:
+            with open(os.path.join(static_dir, emoji.file_path), 'rb') as f:
+                data = f.read()
+            extension = os.path.splitext(emoji.file_path)[1].lstrip('.')
+            path = image_store.put(image_store.locate(current_app.config['IMAGE_STORE_FOLDER'], data, extension), data)
+            small_path, webp_path = small_emoji_images(path)
+        except (OSError, ValueError) as e:
+            click.echo('{}: {}'.format(emoji.name, e))
+            continue
+        emoji.file_path = static_path(path, static_dir)
+        emoji.small_path = static_path(small_path, static_dir)
+        emoji.small_webp_path = static_path(webp_path, static_dir) if webp_path else None
+        moved += 1
+    db.session.commit()
+    reaction_cache.clear()
+    emoji_sprites.rebuild()
+    click.echo('moved {} of {} emojis into the image store. The old files were left in place'.format(moved, len(emojis)))
+
+
+def move_old_avatars():
+    """point users still on a "panel, left, top.bmp" avatar at the same pregenerated cell"""
+    update = User.__table__.update().where(User.__table__.c.id == bindparam('user_id')).values(
+        avatar_path=bindparam('path'))
+    rows = []
+    for user_id, avatar_path in db.session.query(User.id, User.avatar_path).filter(User.avatar_path.like('%.bmp')):
+        cell = random_avatar.old_avatar_cell(avatar_path)
+        if cell:
+            rows.append({'user_id': user_id, 'path': random_avatar.cell_path(*cell)})
+    if rows:
+        db.session.execute(update, rows)
+    db.session.commit()
+    return len(rows)
+
+
+def register(app):
+    @app.cli.group()
+    def markup():
+        """Melon markup commands."""
+        pass
+
+    @markup.command()
+    @click.option('--table', type=click.Choice(sorted(markup_tables)), default=None,
+                  help='Only re-render this table. Defaults to all of them.')
+    @click.option('--start-id', default=0, help='Resume after this id (printed as "last id" in the progress output).')
+    @click.option('--chunk-size', default=1000, help='Rows read, rendered and written per batch.')
+    @click.option('--workers', default=os.cpu_count() or 1, help='Number of render processes.')
+    @click.option('--all', 'rerender_all', is_flag=True,
+                  help='Re-render every row, not only those rendered with an older markup version.')
+    def rerender(table, start_id, chunk_size, workers, rerender_all):
+        """Re-render posts and edit history with the current melon markup."""
+        models = [markup_tables[table]] if table else list(markup_tables.values())
+        if workers > 1:
+            url_config = {key: current_app.config[key] for key in URL_CONFIG_KEYS}
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker,
+                                     initargs=(url_config,)) as pool:
+                for model in models:
+                    rerender_table(model, pool, chunk_size, start_id, rerender_all)
+        else:
+            for model in models:
+                rerender_table(model, None, chunk_size, start_id, rerender_all)
+
+    @app.cli.group()
+    def threads():
+        """Thread maintenance commands."""
+        pass
+
+    @threads.command()
+    def recount():
+        """Rebuild every thread's post_count, last_post_id and last_post_at."""
+        result = db.session.execute(Thread.recount_statement())
+        db.session.commit()
+        click.echo('recounted {} threads'.format(result.rowcount))
+
+    @threads.command()
+    @click.option('--start-id', default=0, help='Resume after this thread id.')
+    @click.option('--chunk-size', default=200, help='Threads renumbered per batch.')
+    def renumber(start_id, chunk_size):
+        """Number every post within its thread by timestamp, closing any gaps left by deletes."""
+        renumber_posts(start_id, chunk_size)
+
+    @app.cli.group()
+    def cache():
+        """Fragment cache commands."""
+        pass
+
+    @cache.command()
+    def clear():
+        """Remove every cached fragment from the configured backend."""
+        fragment_cache.clear()
+        click.echo('cleared the {} fragment cache'.format(current_app.config['FRAGMENT_CACHE'] or 'disabled'))
+
+    @app.cli.group()
+    def emojis():
+        """Emoji commands."""
+        pass
+
+    @emojis.command()
+    @click.option('--workers', default=os.cpu_count() or 1, help='Number of resizing threads.')
+    @click.option('--all', 'resize_all', is_flag=True, help='Resize every emoji, not only those without a WebP version.')
+    def resize(workers, resize_all):
+        """Make the small (animated where the original is) and WebP versions shown in reactions."""
+        resize_emojis(workers, resize_all)
+
+    @emojis.command()
+    def sprites():
+        """Pack the small versions of still emojis into sprite sheets, redrawing only the sheets that changed."""
+        if not current_app.config['EMOJI_SPRITE_FOLDER']:
+            click.echo('EMOJI_SPRITE_FOLDER is not set')
+            return
+        emoji_sprites.rebuild()
+        click.echo('{} emojis in sprite sheets, see {}'.format(len(emoji_sprites.slots), emoji_sprites.stylesheet))
+
+    @emojis.command()
+    def store():
+        """Move emojis uploaded under their original names into the image store."""
+        store_emojis()
+
+    @app.cli.group()
+    def avatars():
+        """Avatar commands."""
+        pass
+
+    @avatars.command()
+    @click.option('--force', is_flag=True, help='Cut out every cell again, not only the missing ones.')
+    def generate(force):
+        """Cut every avatar cell out of the face panels, and move users off the old bmp avatars."""
+        click.echo('wrote {} avatar cells'.format(random_avatar.generate_cells(force)))
+        click.echo('moved {} users to pregenerated avatars'.format(move_old_avatars()))
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    def flush():
+        """Send the changes waiting in the search outbox to the search backend."""
+        if not current_app.search_backend:
+            click.echo('SEARCH_BACKEND is none')
+            return
+        click.echo('sent {} queued changes'.format(search_outbox.flush()))
+
+    @search.command()
+    @click.option('--chunk-size', default=500, help='Rows sent per bulk request.')
+    def reindex(chunk_size):
+        """Send every searchable row to the search backend again."""
+        if not current_app.search_backend:
+            click.echo('SEARCH_BACKEND is none')
+            return
+        for index, model in sorted(SearchableMixin.models().items()):
+            model.reindex(chunk_size)
+            click.echo('reindexed {}'.format(index))
+
+    @search.command()
+    @click.option('--chunk-size', default=5000, help='Rows sent per bulk request.')
+    def rebuild(chunk_size):
+        """Empty the search indexes and fill them again from the database."""
+        backend = current_app.search_backend
+        if not backend:
+            click.echo('SEARCH_BACKEND is none')
+            return
+        for index, model in sorted(SearchableMixin.models().items()):
+            start = time.time()
+            reset_index(index)
+            model.reindex(chunk_size)
+            backend.optimize(index)
+            click.echo('rebuilt {} in {:.1f}s'.format(index, time.time() - start))
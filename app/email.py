@@ -2,11 +2,17 @@ from threading import Thread
 from flask import current_app
 from flask_mail import Message
 from app import mail
+from app.metrics import EMAILS_SENT
 
 
 def send_async_email(app, msg):
     with app.app_context():
-        mail.send(msg)
+        try:
+            mail.send(msg)
+        except Exception:
+            EMAILS_SENT.labels('failed').inc()
+            raise
+        EMAILS_SENT.labels('sent').inc()
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
@@ -0,0 +1,159 @@
+import bisect
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+from flask import has_request_context, request, url_for
+
+EmojiEntry = namedtuple('EmojiEntry', ['id', 'name', 'file_path', 'small_path', 'small_webp_path'])
+
+
+def grams(text, n=2):
+    text = text.lower()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def accepts_webp():
+    # browsers that can show WebP images list image/webp in their Accept header, a bare */* doesn't count
+    return has_request_context() and any(value == 'image/webp' for value, quality in request.accept_mimetypes
+                                         if quality > 0)
+
+
+def small_image(small_path, small_webp_path=None):
+    """the small version of an emoji to show in this response, WebP where the browser takes it as it is far smaller
+    than animated GIFs"""
+    return small_webp_path if small_webp_path and accepts_webp() else small_path
+
+
+class EmojiIndex(object):
+    """Every emoji's name, held in memory for searching from the reaction menu without touching the database.
+
+    Names are kept sorted for prefix lookups with bisect, and every two letter piece of a name maps to the emojis
+    containing it for substring and fuzzy matching. Whenever emojis are added, renamed or deleted the version in
+    EMOJI_INDEX_STAMP is bumped (see the Emoji listeners in models.py), which every worker checks before answering,
+    so the index is only reloaded when something has actually changed."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.loaded_version = None
+        self.entries = []  # sorted by lowercase name
+        self.names = []  # lowercase names, same order as entries
+        self.postings = {}  # two letters: set of positions in entries
+        self.manifest_cache = None  # (digest, json) for loaded_version
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.stamp_path = app.config['EMOJI_INDEX_STAMP']
+        with self.lock:
+            self.loaded_version = None
+            self.manifest_cache = None
+        app.add_template_global(self.manifest_url, 'emoji_manifest_url')
+        app.add_template_global(accepts_webp)
+        app.add_template_global(small_image, 'emoji_small_image')
+
+    def current_version(self):
+        try:
+            with open(self.stamp_path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def bump(self):
+        """mark the index stale in every process"""
+        directory = os.path.dirname(self.stamp_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}-{}'.format(time.time_ns(), os.getpid()))
+        os.replace(temp_path, self.stamp_path)
+
+    def refresh(self):
+        version = self.current_version()
+        if version == self.loaded_version:
+            return
+        from app.models import Emoji
+        emojis = Emoji.query.with_entities(Emoji.id, Emoji.name, Emoji.file_path, Emoji.small_path,
+                                           Emoji.small_webp_path).all()
+        entries = sorted((EmojiEntry(*emoji) for emoji in emojis if emoji.name), key=lambda e: (e.name.lower(), e.id))
+        postings = defaultdict(set)
+        for position, entry in enumerate(entries):
+            for gram in grams(entry.name):
+                postings[gram].add(position)
+        with self.lock:
+            self.entries = entries
+            self.names = [entry.name.lower() for entry in entries]
+            self.postings = dict(postings)
+            self.loaded_version = version
+            self.manifest_cache = None
+
+    def count(self):
+        self.refresh()
+        return len(self.entries)
+
+    def all(self):
+        self.refresh()
+        return list(self.entries)
+
+    def manifest(self):
+        """(digest, json) listing every emoji in the reaction menu's order, for react_menu.js to page and filter
+        without asking the server. The digest only changes with the emoji set, so the json can be cached for good
+        under a url containing it"""
+        self.refresh()
+        with self.lock:
+            manifest, entries = self.manifest_cache, self.entries
+        if manifest is None:
+            # built outside the lock, as looking up the sprites can refresh the index
+            from app import emoji_sprites
+            emojis = sorted((entry for entry in entries if entry.id > 0), key=lambda e: e.id)
+            body = json.dumps({'emojis': [{'id': e.id, 'name': e.name, 'small_path': e.small_path,
+                                           'small_webp_path': e.small_webp_path,
+                                           'sprite': emoji_sprites.sprite_class(e.small_path)} for e in emojis]},
+                              separators=(',', ':'))
+            manifest = (hashlib.sha1(body.encode('utf-8')).hexdigest()[:16], body)
+            with self.lock:
+                if self.entries is entries:
+                    self.manifest_cache = manifest
+        return manifest
+
+    def manifest_url(self):
+        return url_for('main.emoji_manifest', digest=self.manifest()[0])
+
+    def search(self, query, limit=20, fuzzy=True):
+        """emojis whose names start with query, then ones containing it, then (if there is room and fuzzy is set) the
+        ones sharing the most two letter pieces with it"""
+        self.refresh()
+        query = query.lower()
+        with self.lock:
+            entries, names, postings = self.entries, self.names, self.postings
+
+        start = bisect.bisect_left(names, query)
+        end = bisect.bisect_left(names, query + '\uffff')
+        results = list(range(start, min(end, start + limit)))
+        if len(results) >= limit or not query:
+            return [entries[i] for i in results]
+
+        found = set(range(start, end))
+        query_grams = grams(query)
+        if query_grams:
+            candidates = set.intersection(*(postings.get(gram, set()) for gram in query_grams))
+        else:
+            # a single letter, there are too few emojis for this to be worth indexing
+            candidates = range(len(entries))
+        results += sorted(i for i in candidates if i not in found and query in names[i])[:limit - len(results)]
+
+        if fuzzy and len(results) < limit and len(query_grams) > 1:
+            found.update(results)
+            scores = defaultdict(int)
+            for gram in query_grams:
+                for i in postings.get(gram, ()):
+                    if i not in found:
+                        scores[i] += 1
+            # at least half of the query has to turn up in the name
+            close = [i for i, score in scores.items() if score * 2 >= len(query_grams)]
+            close.sort(key=lambda i: (-scores[i] / len(grams(names[i]) | query_grams), names[i]))
+            results += close[:limit - len(results)]
+        return [entries[i] for i in results]
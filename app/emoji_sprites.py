@@ -0,0 +1,203 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import threading
+from flask import g, has_request_context, url_for
+from PIL import Image
+from app.image_store import write_atomic
+
+CELL = 35  # pixels, the size of the small versions
+COLUMNS = 16
+ROWS = 16
+PREFIX = 'emoji-sprites'  # of the files written
+CLASS = 'emoji-sprite'
+# the src of sprite <img>s, a transparent pixel so that the emoji shows through from the background
+BLANK_IMAGE = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
+
+
+class EmojiSprites(object):
+    """Packs the small version of every still emoji into sprite sheets, so that a page of reactions or the reaction
+    menu loads one or two images instead of one per emoji.
+
+    The sheets are built by whatever changes the emojis (ingest_emojis, deleting one, the emoji commands) or with
+    "flask emojis sprites", never while rendering a page. Each emoji keeps its slot between builds and only sheets
+    whose emojis changed are drawn again. Everything is written to EMOJI_SPRITE_FOLDER under content-hashed names: the
+    sheets, a stylesheet with one class per slot and a json map. Pages load the map at most once per request, and only
+    read it again once a build has replaced it. Animated emojis are left out and keep their own files."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.folder = None
+        self.loaded_version = None  # file id and modification time of the map that was loaded
+        self.slots = {}  # small_path: slot
+        self.stylesheet = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['EMOJI_SPRITE_FOLDER']
+        self.static_folder = app.static_folder
+        with self.lock:
+            self.loaded_version = None
+            self.slots = {}
+            self.stylesheet = None
+        app.add_template_global(self.sprite_class, 'emoji_sprite')
+        app.add_template_global(self.stylesheet_url, 'emoji_sprite_stylesheet')
+        app.add_template_global(BLANK_IMAGE, 'emoji_sprite_blank')
+
+    def load(self):
+        """pick up the map written by the latest build, checking for one at most once per request"""
+        if not self.folder:
+            return
+        if has_request_context():
+            if g.get('emoji_sprites_checked'):
+                return
+            g.emoji_sprites_checked = True
+        try:
+            version = file_version(self.map_path())
+        except FileNotFoundError:
+            version = None
+        if version == self.loaded_version:
+            return
+        sprites = self.read_map() or {}
+        with self.lock:
+            self.slots = sprites.get('slots', {})
+            self.stylesheet = sprites.get('stylesheet')
+            self.loaded_version = version
+
+    def rebuild(self):
+        """bring the sheets up to date with the emojis, after they have been changed"""
+        if not self.folder:
+            return
+        from app import emoji_index
+        with self.build_lock:
+            sprites = self.build(emoji_index.all(), self.read_map() or {})
+            version = file_version(self.map_path())
+        with self.lock:
+            self.slots = sprites['slots']
+            self.stylesheet = sprites['stylesheet']
+            self.loaded_version = version
+
+    def sprite_class(self, small_path):
+        """the classes showing small_path from a sprite sheet, or None if it isn't in one"""
+        self.load()
+        slot = self.slots.get(small_path)
+        return '{0} {0}-{1}'.format(CLASS, slot) if slot is not None else None
+
+    def stylesheet_url(self):
+        self.load()
+        if not self.stylesheet:
+            return None
+        return url_for('static', filename=self.static_path(self.stylesheet))
+
+    def static_path(self, name):
+        return os.path.relpath(os.path.join(self.folder, name), self.static_folder).replace('\\', '/')
+
+    def map_path(self):
+        return os.path.join(self.folder, PREFIX + '.json')
+
+    def read_map(self):
+        try:
+            with open(self.map_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def build(self, entries, previous):
+        """write the sheets, stylesheet and map for entries, reusing what previous (the last map) already has"""
+        os.makedirs(self.folder, exist_ok=True)
+        known = previous.get('files', {})  # small_path: [mtime, still]
+        files = {}
+        stills = []
+        for entry in sorted(entries, key=lambda e: e.id):
+            path = entry.small_path
+            if entry.id <= 0 or not path or path in files:
+                continue
+            full_path = os.path.join(self.static_folder, path)
+            try:
+                mtime = os.path.getmtime(full_path)
+            except OSError:
+                continue
+            if path in known and known[path][0] == mtime:
+                still = known[path][1]
+            else:
+                still = is_still(full_path)
+            files[path] = [mtime, still]
+            if still:
+                stills.append(path)
+
+        slots = {path: slot for path, slot in previous.get('slots', {}).items() if path in stills}
+        taken = set(slots.values())
+        slot = 0
+        for path in stills:
+            if path not in slots:
+                while slot in taken:
+                    slot += 1
+                slots[path] = slot
+                taken.add(slot)
+
+        per_sheet = COLUMNS * ROWS
+        sheets = []
+        for sheet in range(max(taken) // per_sheet + 1 if taken else 0):
+            members = sorted((s, path, files[path][0]) for path, s in slots.items() if s // per_sheet == sheet)
+            name = '{}-{}-{}.png'.format(PREFIX, sheet, fingerprint(json.dumps(members)))
+            if not os.path.exists(os.path.join(self.folder, name)):
+                self.draw(name, [(s % per_sheet, path) for s, path, mtime in members])
+            sheets.append(name)
+
+        rules = ['.{} {{ background-size: {}% {}%; background-repeat: no-repeat; }}'.format(
+            CLASS, COLUMNS * 100, ROWS * 100)]
+        for path, s in sorted(slots.items(), key=lambda item: item[1]):
+            column, row = s % per_sheet % COLUMNS, s % per_sheet // COLUMNS
+            rules.append('.{}-{} {{ background-image: url({}); background-position: {:.4f}% {:.4f}%; }}'.format(
+                CLASS, s, sheets[s // per_sheet], column * 100 / (COLUMNS - 1), row * 100 / (ROWS - 1)))
+        css = '\n'.join(rules) + '\n'
+        stylesheet = '{}-{}.css'.format(PREFIX, fingerprint(css))
+        write_atomic(os.path.join(self.folder, stylesheet), css.encode('utf-8'))
+
+        sprites = {'files': files, 'slots': slots, 'sheets': sheets, 'stylesheet': stylesheet}
+        write_atomic(self.map_path(), json.dumps(sprites).encode('utf-8'))
+
+        keep = set(sheets) | {stylesheet, PREFIX + '.json'}
+        for name in os.listdir(self.folder):
+            if name.startswith(PREFIX) and name not in keep and not name.endswith('.tmp'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.folder, name))
+        return sprites
+
+    def draw(self, name, cells):
+        sheet = Image.new('RGBA', (COLUMNS * CELL, ROWS * CELL))
+        for cell, path in cells:
+            try:
+                img = Image.open(os.path.join(self.static_folder, path)).convert('RGBA')
+            except (OSError, ValueError):
+                continue
+            img.thumbnail((CELL, CELL))
+            # centred in its cell
+            x = cell % COLUMNS * CELL + (CELL - img.size[0]) // 2
+            y = cell // COLUMNS * CELL + (CELL - img.size[1]) // 2
+            sheet.paste(img, (x, y), img)
+        data = io.BytesIO()
+        sheet.save(data, 'PNG', optimize=True)
+        write_atomic(os.path.join(self.folder, name), data.getvalue())
+
+
+def file_version(path):
+    # each build replaces the map with a new file, so this changes even where modification times are coarse
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def is_still(path):
+    try:
+        return not getattr(Image.open(path), 'is_animated', False)
+    except (OSError, ValueError):
+        return False
+
+
+def fingerprint(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
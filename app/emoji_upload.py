@@ -0,0 +1,145 @@
+import contextlib
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.utils import secure_filename
+from app import db, image_store, emoji_sprites
+from app.metrics import EMOJI_UPLOADS
+
+UploadResult = namedtuple('UploadResult', ['filename', 'saved', 'message', 'emoji_name'])
+
+ALLOWED_EXTENSIONS = ('gif', 'png', 'jpg', 'jpeg', 'webp', 'ico', 'bmp', 'svg', 'tif', 'tiff')
+CHUNK_SIZE = 64 * 1024
+
+
+class Upload(object):
+    # one uploaded file on its way through the pipeline
+    def __init__(self, filename):
+        self.filename = filename
+        self.error = None
+        self.data = None
+        self.file_path = None  # relative to app/static, like Emoji.file_path
+        self.small_path = None
+        self.small_webp_path = None
+
+
+def ingest_emojis(files):
+    """Adds every uploaded file as a new emoji, returning an UploadResult per file in the order given.
+
+    Files are read in chunks and dropped as soon as they go over MAX_EMOJI_SIZE, so nothing oversized is ever written.
+    The rest go into the image store under the hash of their contents, so a second upload of the same image turns into
+    a "duplicate" result. Saving them and making their small versions happens on
+    EMOJI_RESIZE_WORKERS threads, and then every Emoji row is added in a single commit. The sprite sheets are redrawn
+    here too, rather than by the next page view"""
+    from app.models import Emoji
+    config = current_app.config
+    static_dir = os.path.join(current_app.root_path, 'static')
+
+    uploads = []
+    for storage in files:
+        upload = Upload(storage.filename or '')
+        uploads.append(upload)
+        extension = secure_filename(upload.filename).rpartition('.')[2].lower()
+        if extension not in ALLOWED_EXTENSIONS:
+            upload.error = 'not a {} file'.format('/'.join(ALLOWED_EXTENSIONS))
+            continue
+        data = read_limited(storage.stream, config['MAX_EMOJI_SIZE'])
+        if data is None:
+            upload.error = 'larger than {} bytes'.format(config['MAX_EMOJI_SIZE'])
+            continue
+        upload.data = data
+        upload.file_path = static_path(image_store.locate(config['IMAGE_STORE_FOLDER'], data, extension), static_dir)
+
+    stored = [upload for upload in uploads if upload.error is None]
+    paths = {upload.file_path for upload in stored}
+    existing = {path for path, in db.session.query(Emoji.file_path).filter(Emoji.file_path.in_(paths))} if paths else ()
+    seen = set()
+    for upload in stored:
+        if upload.file_path in existing or upload.file_path in seen:
+            upload.error = 'duplicate of an existing emoji'
+        seen.add(upload.file_path)
+
+    room = config['MAX_NUMBER_OF_EMOJIS'] - Emoji.query.count()
+    accepted = []
+    for upload in stored:
+        if upload.error is None:
+            if len(accepted) < room:
+                accepted.append(upload)
+            else:
+                upload.error = 'max emoji limit reached'
+
+    with ThreadPoolExecutor(max_workers=config['EMOJI_RESIZE_WORKERS']) as executor:
+        small_paths = executor.map(lambda upload: store(os.path.join(static_dir, upload.file_path), upload.data),
+                                   accepted)
+        for upload, (small_path, webp_path) in zip(accepted, small_paths):
+            if small_path is None:
+                upload.error = 'not a readable image'
+            else:
+                upload.small_path = static_path(small_path, static_dir)
+                upload.small_webp_path = static_path(webp_path, static_dir) if webp_path else None
+            upload.data = None
+
+    accepted = [upload for upload in accepted if upload.error is None]
+    names = free_names(len(accepted))
+    emoji_names = {}
+    for upload, name in zip(accepted, names):
+        db.session.add(Emoji(name=name, file_path=upload.file_path, small_path=upload.small_path,
+                             small_webp_path=upload.small_webp_path))
+        emoji_names[id(upload)] = name
+    db.session.commit()
+    if accepted:
+        emoji_sprites.rebuild()
+
+    results = []
+    for upload in uploads:
+        saved = upload.error is None
+        EMOJI_UPLOADS.labels('saved' if saved else 'rejected').inc()
+        results.append(UploadResult(upload.filename, saved, 'saved' if saved else upload.error,
+                                    emoji_names.get(id(upload))))
+    return results
+
+
+def read_limited(stream, max_size):
+    """the stream's contents, or None once it turns out to be over max_size bytes"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+
+
+def static_path(path, static_dir):
+    return os.path.relpath(path, static_dir).replace('\\', '/')
+
+
+def store(path, data):
+    """save data at path and make its small versions, see small_emoji_images. Returns their paths, or (None, None)
+    with nothing saved if data isn't an image"""
+    from app.models import small_emoji_images
+    image_store.put(path, data)
+    try:
+        return small_emoji_images(path)
+    except (OSError, ValueError):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return None, None
+
+
+def free_names(n):
+    """n default names, emoji_<id> counting up from the highest id and skipping any already in use"""
+    from app.models import Emoji
+    next_id = (db.session.query(db.func.max(Emoji.id)).scalar() or 0) + 1
+    taken = {name for name, in db.session.query(Emoji.name).filter(Emoji.name.like('emoji\\_%', escape='\\'))}
+    names = []
+    while len(names) < n:
+        name = 'emoji_' + str(next_id)
+        if name not in taken:
+            names.append(name)
+        next_id += 1
+    return names
@@ -0,0 +1,169 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import render_template
+from markupsafe import Markup
+from app.metrics import FRAGMENT_CACHE_REQUESTS
+
+
+class LRUBackend(object):
+    """keeps up to max_entries fragments in this process"""
+
+    def __init__(self, max_entries):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FilesystemBackend(object):
+    """one file per fragment in a directory shared by every worker. Files older than ttl seconds are ignored, and
+    "flask cache clear" removes them all"""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.html')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        # written to a temporary file first so that other workers never read half a fragment
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(temp_path, self.path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.html'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, name))
+
+
+class RedisBackend(object):
+    """a Redis (or Redis compatible) server shared by every worker. Needs the redis package"""
+
+    def __init__(self, url, ttl):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('FRAGMENT_CACHE = "redis" needs the redis package installed')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+
+    def get(self, key):
+        value = self.client.get('fragment:' + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set('fragment:' + key, value.encode('utf-8'), ex=self.ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter('fragment:*'):
+            self.client.delete(key)
+
+
+class FragmentCache(object):
+    """Caches rendered template fragments by key, see FRAGMENT_CACHE for the backends.
+
+    Keys have to change whenever the output would, ie. they include Post.version or the values the fragment shows,
+    so nothing is ever invalidated explicitly and stale entries simply age out. Templates use cached_fragment(key,
+    template_name, **context), which renders and stores the fragment on a miss. Every key is prefixed with a digest of
+    the app's templates, so that a deploy changing any of them doesn't serve fragments rendered by the old ones from a
+    shared backend."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.prefix = ''
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config['FRAGMENT_CACHE']
+        if kind == 'lru':
+            self.backend = LRUBackend(app.config['FRAGMENT_CACHE_SIZE'])
+        elif kind == 'filesystem':
+            self.backend = FilesystemBackend(app.config['FRAGMENT_CACHE_DIR'], app.config['FRAGMENT_CACHE_TTL'])
+        elif kind == 'redis':
+            self.backend = RedisBackend(app.config['FRAGMENT_CACHE_REDIS_URL'], app.config['FRAGMENT_CACHE_TTL'])
+        elif kind:
+            raise ValueError('unknown FRAGMENT_CACHE backend {}'.format(kind))
+        else:
+            self.backend = None
+        self.prefix = templates_digest(app) + ':'
+        app.add_template_global(self.cached_fragment)
+        app.add_template_global(digest, 'fragment_digest')
+
+    def cached_fragment(self, key, template_name, **context):
+        if self.backend is None:
+            return Markup(render_template(template_name, **context))
+        key = self.prefix + key
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            FRAGMENT_CACHE_REQUESTS.labels('miss').inc()
+            value = render_template(template_name, **context)
+            self.backend.set(key, value)
+        else:
+            self.hits += 1
+            FRAGMENT_CACHE_REQUESTS.labels('hit').inc()
+        return Markup(value)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def digest(*values):
+    """a short stable stamp for the values a fragment depends on, for use in keys"""
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+
+def templates_digest(app):
+    """a digest of the source of every template in the app's template folder"""
+    loader = app.jinja_loader
+    sources = []
+    if loader is not None:
+        for name in sorted(loader.list_templates()):
+            source, filename, uptodate = loader.get_source(app.jinja_env, name)
+            sources.append((name, source))
+    return digest(*sources)
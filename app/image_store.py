@@ -0,0 +1,31 @@
+import hashlib
+import os
+import tempfile
+
+# Uploaded images are kept under the sha256 of their contents, in IMAGE_STORE_FOLDER/ab/cd/abcd....ext. Identical
+# uploads end up as the same file, nothing has to be probed for a free name, and as a file never changes once written
+# it can be cached for good (see nginx.conf). The two levels of two hex digits keep every directory small however many
+# images there are. Versions derived from an image, like the small emojis, are written next to it with a suffix.
+
+
+def locate(folder, data, extension):
+    """the path data is (or will be) stored at"""
+    digest = hashlib.sha256(data).hexdigest()
+    return os.path.join(folder, digest[:2], digest[2:4], '{}.{}'.format(digest, extension.lower()))
+
+
+def put(path, data):
+    """store data at the path given by locate, unless it is already there"""
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+    return path
+
+
+def write_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    # mkstemp makes the file readable by its owner only, these are served as static files
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
@@ -1,22 +1,20 @@
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, current_app, jsonify
 from flask_login import current_user, login_required
-from app import db
+from app import db, presence, reaction_cache, emoji_index, emoji_sprites
 from app.main.forms import (EditProfileForm, PostForm, CreateCategoryForm, CreateThreadForm, SearchForm, MessageForm)
 from app.models import User, Post, Thread, Category, Message, PostReaction, Emoji, EditHistory
 from app.main import bp
-import os
-import re
-from sqlalchemy import func
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 from app.utils import require_mod_level
+from app.pagination import keyset_paginate
+from app.emoji_upload import ingest_emojis
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        presence.seen(current_user.id)
         g.search_form = SearchForm()
 
 
@@ -27,14 +25,22 @@ def index():
     page = request.args.get('page', 1, type=int)
     categories = Category.query.order_by(Category.timestamp.asc()).paginate(
         page, current_app.config['CATEGORIES_PER_PAGE'], False)
+    active_threads = Category.active_threads_by_category(
+        categories.items, current_app.config['ACTIVE_THREADS_PER_CATEGORY'])
+    read_states = current_user.get_thread_read_states(
+        [thread for threads in active_threads.values() for thread in threads])
+    online_ids = presence.online()
+    online_users = User.query.filter(User.id.in_(online_ids)).order_by(User.username.asc()).all() \
+        if online_ids else []
 
     next_url = url_for('main.index', page=categories.next_num) \
         if categories.has_next else None
     prev_url = url_for('main.index', page=categories.prev_num) \
         if categories.has_prev else None
     return render_template('index.html', title='Home',
-                           categories=categories.items, next_url=next_url,
-                           prev_url=prev_url)
+                           categories=categories.items, active_threads=active_threads,
+                           read_states=read_states, online_users=online_users,
+                           next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/user/<username>')
@@ -42,13 +48,18 @@ def index():
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
-    return render_template('user.html', user=user, posts=posts.items,
+    # nothing stored changes along with the user's posts, so a new post only shifts the pages once the cached
+    # boundaries expire (PAGE_BOUNDARY_CACHE_TTL). Counting them to notice would cost what the boundaries save
+    boundary_key = ('user_posts', user.id)
+    posts = keyset_paginate(user.posts.options(joinedload(Post.thread)), (Post.timestamp, Post.id),
+                            current_app.config['POSTS_PER_PAGE'], page=page, cursor=request.args.get('cursor'),
+                            descending=True, boundary_key=boundary_key)
+    next_url = url_for('main.user', username=user.username, page=posts.next_num,
+                       cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username, page=posts.prev_num,
+                       cursor=posts.prev_cursor) if posts.has_prev else None
+    return render_template('user.html', user=user, posts=Post.views(posts.items, current_user),
+                           last_seen=presence.get_last_seen(user.id, user.last_seen),
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -112,14 +123,18 @@ def category(category_id):
         return redirect(url_for('main.index'))
 
     page = request.args.get('page', 1, type=int)
-    threads = category.threads.order_by(Thread.timestamp.asc()).paginate(
-        page, current_app.config['THREADS_PER_PAGE'], False)
-    next_url = url_for('main.category', page=threads.next_num, category_id=category_id) \
+    # new threads come last, so until the cached boundaries expire they only make the last page run on
+    boundary_key = ('category_threads', category.id)
+    threads = keyset_paginate(category.threads.options(*Thread.listing_options()), (Thread.timestamp, Thread.id),
+                              current_app.config['THREADS_PER_PAGE'], page=page, cursor=request.args.get('cursor'),
+                              boundary_key=boundary_key)
+    next_url = url_for('main.category', page=threads.next_num, cursor=threads.next_cursor, category_id=category_id) \
         if threads.has_next else None
-    prev_url = url_for('main.category', page=threads.prev_num, category_id=category_id) \
+    prev_url = url_for('main.category', page=threads.prev_num, cursor=threads.prev_cursor, category_id=category_id) \
         if threads.has_prev else None
+    read_states = current_user.get_thread_read_states(threads.items)
     return render_template('category.html', title=category.title, category=category, threads=threads.items,
-                           next_url=next_url, prev_url=prev_url)
+                           read_states=read_states, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/cat/<category_id>/create_thread', methods=['GET', 'POST'])
@@ -279,45 +294,51 @@ def thread(thread_id):
 
     # if page is not specified, find the user's last post and redirect to it.
     page = request.args.get('page', None, type=int)
+    cursor = request.args.get('cursor')
 
     '''This is a weird work-around to anchor to a specific post-id
     Basically, if no page is provided, it will find a page & anchor
     value, and re-route to itself. Since page will have a value this
     time, it will skip over this section of the code'''
-    if not page:
+    if not page and not cursor:
         last_page_viewed, last_post_id = current_user.get_user_thread_position(thread=thread)
         page = last_page_viewed if last_page_viewed else 1
         anchor = 'p' + str(last_post_id) if last_post_id else None
         return redirect(
             url_for('main.thread', thread_id=thread_id, page=page, _anchor=anchor))
 
-    page = request.args.get('page', 1, type=int)
-
-    posts = thread.posts.order_by(Post.timestamp.asc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-
+    # while the seqs of the posts are their positions, a page starts right after seq (page - 1) * POSTS_PER_PAGE.
+    # Otherwise the page boundaries are looked up, and only have to be again once posts have been added or removed
+    page = page or 1
+    per_page = current_app.config['POSTS_PER_PAGE']
+    seek = Post.seq > (page - 1) * per_page if page > 1 and not cursor and thread.numbered_without_gaps() else None
+    posts = keyset_paginate(thread.posts.options(joinedload(Post.author)), (Post.timestamp, Post.id), per_page,
+                            page=page, cursor=cursor, seek=seek,
+                            boundary_key=('thread_posts', thread.id, thread.post_count, thread.last_post_id),
+                            pages=thread.last_page())
+
+    # build the views for the pinned post and the page together so that it's all loaded in a fixed number of queries
     pinned_post = thread.pinned_post
+    post_views = Post.views(([pinned_post] if pinned_post else []) + posts.items, current_user)
+    pinned_post = post_views.pop(0) if pinned_post else None
 
     next_url = url_for('main.thread', thread_id=thread_id,
-                       page=posts.next_num) \
+                       page=posts.next_num, cursor=posts.next_cursor) \
         if posts.has_next else None
     prev_url = url_for('main.thread', thread_id=thread_id,
-                       page=posts.prev_num) \
+                       page=posts.prev_num, cursor=posts.prev_cursor) \
         if posts.has_prev else None
 
-    # add 1 view to the user's view count for this thread
-    current_user.view_thread(thread=thread)
+    last_viewed_timestamp = posts.items[-1].timestamp if posts.items else None
+    rendered = render_template('thread.html', title=thread.title, form=form, page=page,
+                               posts=posts, post_views=post_views, pinned_post=pinned_post, next_url=next_url,
+                               thread=thread, prev_url=prev_url)
 
-    # if the thread is not empty, update the user's last_viewed_timestamp
-    if posts.items:
-        last_viewed_timestamp = posts.items[-1].timestamp
-        current_user.set_last_viewed_timestamp(
-            thread=thread,
-            last_viewed_timestamp=last_viewed_timestamp)
-
-    return render_template('thread.html', title=thread.title, form=form, page=page,
-                           posts=posts, pinned_post=pinned_post, next_url=next_url,
-                           thread=thread, prev_url=prev_url)
+    # add 1 view to the user's view count for this thread and, if the thread is not empty,
+    # update the user's last_viewed_timestamp. This is done after rendering because a synchronous write commits,
+    # which would expire everything loaded for the page
+    current_user.view_thread(thread=thread, last_viewed_timestamp=last_viewed_timestamp)
+    return rendered
 
 
 @bp.route('/reaction_menu', methods=['GET'])
@@ -337,6 +358,21 @@ def reaction_menu():
                            post_id=post_id, next_emoji_url=next_emoji_url, prev_emoji_url=prev_emoji_url)
 
 
+@bp.route('/emoji_manifest/<digest>.json', methods=['GET'])
+@login_required
+def emoji_manifest(digest):
+    current, body = emoji_index.manifest()
+    if digest != current:
+        # an old page asking for a previous emoji set
+        return redirect(url_for('main.emoji_manifest', digest=current))
+    response = current_app.response_class(body, mimetype='application/json')
+    response.cache_control.private = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    response.set_etag(current)
+    return response.make_conditional(request)
+
+
 @bp.route('/search_emojis', methods=['GET'])
 @login_required
 def search_emojis():
@@ -347,10 +383,7 @@ def search_emojis():
     search_string = request.args.get('search_string', "", type=str)
 
     post_id = request.args.get('post_id', 0, type=int)
-    emojis = Emoji.query.all()
-    result = [e for e in emojis if e.name.startswith(search_string)]
-    result.sort(key=lambda x: x.name)
-    result = result[:20]
+    result = emoji_index.search(search_string, limit=20)
     return render_template("_emoji_grid.html", emojis=result, starting_page=None, post_id=post_id,
                            next_emoji_url=None, prev_emoji_url=None)
 
@@ -490,19 +523,16 @@ def delete_post(post_id):
 
     # info for redirect
     thread_id = post.thread.id
-    try:
-        previous_post = post.thread.posts.filter(Post.timestamp < post.timestamp)[-1]
-        anchor = 'p' + str(previous_post.id)
-    except IndexError:
-        # exception occurs when there is no previous post
-        anchor = ''
+    page = post.page()
+    previous_post = post.thread.posts.filter(Post.timestamp < post.timestamp).order_by(Post.timestamp.desc()).first()
+    anchor = 'p' + str(previous_post.id) if previous_post else ''
 
     db.session.delete(post)
     db.session.commit()
 
     return redirect(
         url_for('main.thread', thread_id=thread_id,
-                page=post.page(), _anchor=anchor))
+                page=page, _anchor=anchor))
 
 
 @bp.route('/post/<post_id>')
@@ -523,13 +553,12 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    results, total = Post.search_results(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
         if page > 1 else None
-    return render_template('search.html', title='Search', posts=posts,
+    return render_template('search.html', title='Search', results=results,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -555,90 +584,32 @@ def messages():
     current_user.last_message_read_time = datetime.utcnow()
     db.session.commit()
     page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
+    # like the user's posts, new messages shift the pages once the cached boundaries expire
+    boundary_key = ('messages', current_user.id)
+    messages = keyset_paginate(current_user.messages_received, (Message.timestamp, Message.id),
+                               current_app.config['POSTS_PER_PAGE'], page=page, cursor=request.args.get('cursor'),
+                               descending=True, boundary_key=boundary_key)
+    next_url = url_for('main.messages', page=messages.next_num, cursor=messages.next_cursor) \
         if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
+    prev_url = url_for('main.messages', page=messages.prev_num, cursor=messages.prev_cursor) \
         if messages.has_prev else None
     return render_template('messages.html', messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 
-def valid_extension(filepath):
-    allowed_extensions = ("gif", "png", "jpg", "jpeg", "ico", "bmp", "svg", "tif", "tiff")
-    pattern = ".+[.](.+)"
-    try:
-        extension = re.match(pattern, filepath).groups()[0]
-    except AttributeError:
-        return False
-    if extension not in allowed_extensions:
-        return False
-    return True
-
-
 @bp.route('/emojis', methods=['GET', 'POST'])
 @login_required
 def emojis():
     if request.method == 'POST':
-        images = request.files.getlist("images")
-        for image in images:
-
-            if len(Emoji.query.all()) > current_app.config['MAX_NUMBER_OF_EMOJIS']:
-                return "Max emoji limit reached", 400
-
-            filename = secure_filename(image.filename)
-
-            if not valid_extension(filename):
-                continue  # TODO: communicate back to client that image was skipped over
-
-            # Save as unique filename
-            retries = 0
-            while retries < 999:
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], "emojis", filename)
-                if not os.path.exists(filepath):
-                    image.save(filepath)
-                    break
-                else:
-                    pattern = r'(.+?)' + '({})*'.format(retries-1) + r'(\.[^.\\/:*?"<>|\r\n]+$)'
-                    match = re.match(pattern, filename)
-                    filename = match.groups()[0] + str(retries) + match.groups()[2]
-                    retries += 1
-
-            if os.stat(filepath).st_size > current_app.config['MAX_EMOJI_SIZE']:
-                os.remove(filepath)
-                continue  # TODO: communicate back to client that image was skipped over
-
-            # rel_path is like "app/static/images/emoji/filename.jpg"
-            # rel_static_path is like "images/emoji/filename.jpg"
-            # the first is needed for file-saving. The second is needed for rendering on the webpage
-            rel_path = os.path.relpath(filepath, os.getcwd())
-            rel_static_path = os.path.relpath(filepath, os.path.join(os.getcwd(), "app", "static"))
-            rel_static_path = rel_static_path.replace("\\", "/")
-
-            # find a first name to based on id
-            try:
-                total_emojis = len(Emoji.query.all())
-            except:
-                total_emojis = 0
-            if total_emojis > 0:
-                emoji_id = db.session.query(func.max(Emoji.id)).first()[0] + 1
-            else:
-                emoji_id = 1
-
-            retries = 0
-            while retries < current_app.config['MAX_NUMBER_OF_EMOJIS']:
-                emoji_name = "emoji_" + str(emoji_id)
-                emoji = Emoji(name=emoji_name, file_path=rel_static_path)
-                try:
-                    db.session.add(emoji)
-                    db.session.commit()
-                    break
-                except IntegrityError:
-                    db.session.rollback() #  db.session will remain broken after a failed commit() unless this is called
-                    emoji_id += 1
-                    retries += 1
+        results = ingest_emojis(request.files.getlist("images"))
+        if request.args.get('format') == 'json':
+            return jsonify([result._asdict() for result in results])
+        for result in results:
+            if not result.saved:
+                flash('{} was skipped: {}'.format(result.filename, result.message))
+        saved = sum(result.saved for result in results)
+        if saved:
+            flash('{} emoji{} added'.format(saved, '' if saved == 1 else 's'))
         return redirect(url_for("main.emojis"))
 
     emojis = Emoji.query.all()
@@ -652,6 +623,8 @@ def delete_emoji(emoji_id):
     if emoji:
         db.session.delete(emoji)
         db.session.commit()
+        reaction_cache.clear()
+        emoji_sprites.rebuild()
     return redirect(url_for('main.emojis'))
 
 
@@ -668,6 +641,7 @@ def rename_emoji():
     try:
         emoji.name = new_name
         db.session.commit()
+        reaction_cache.clear()
         return "", 204
     except IntegrityError:
         return "name taken", 400
@@ -686,14 +660,16 @@ def reactions():
             if reaction:
                 db.session.delete(reaction)
                 db.session.commit()
+                reaction_cache.invalidate(post.id)
         else:
             if not PostReaction.query.filter_by(post=post, emoji=emoji, user=current_user).first():
                 if not post.reactions.count() >= 42:
                     reaction = PostReaction(post=post, emoji=emoji, user=current_user)
                     db.session.add(reaction)
                     db.session.commit()
+                    reaction_cache.invalidate(post.id)
 
     reactions = []
     if post:
-        reactions = post.reactions
+        reactions = PostReaction.summaries([post.id], current_user)[post.id]
     return render_template('_reactions.html', reactions=reactions, post=post)
@@ -0,0 +1,99 @@
+import os
+import time
+from flask import abort, current_app, g, has_app_context, request, Response
+from flask_login import current_user
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# with several gunicorn workers each one writes its values to PROMETHEUS_MULTIPROC_DIR (see boot.sh), which has to be
+# set before this module is imported. /metrics then adds up the files of every worker
+
+REQUEST_LATENCY = Histogram('melly_request_duration_seconds', 'Time spent handling a request',
+                            ['endpoint', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('melly_requests_in_flight', 'Requests currently being handled', ['endpoint'],
+                           multiprocess_mode='livesum')
+DB_QUERIES = Histogram('melly_request_db_queries', 'SQL statements run per request', ['endpoint'],
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+DB_TIME = Histogram('melly_request_db_seconds', 'Time spent in the database per request', ['endpoint'],
+                    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+MARKUP_RENDERS = Counter('melly_markup_renders_total', 'Melon markup bodies rendered to html')
+SEARCH_CALLS = Counter('melly_search_calls_total', 'Calls to the search index', ['operation'])
+EMOJI_UPLOADS = Counter('melly_emoji_uploads_total', 'Uploaded emoji images', ['result'])
+EMAILS_SENT = Counter('melly_emails_sent_total', 'Emails handed to the mail server', ['result'])
+FRAGMENT_CACHE_REQUESTS = Counter('melly_fragment_cache_requests_total', 'Fragment cache lookups', ['result'])
+
+
+class Metrics(object):
+    """Records request latency, requests in flight and database use per endpoint, and serves everything at /metrics
+    in the Prometheus text format. /metrics only answers local requests and users with METRICS_MOD_LEVEL."""
+
+    def __init__(self, app=None):
+        self.listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not self.listening:
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            self.listening = True
+        app.before_request(start_request)
+        app.after_request(record_status)
+        app.teardown_request(finish_request)
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+def endpoint_label():
+    # only known endpoints are used as labels, so that scanning for random urls can't create new series
+    return request.endpoint or 'none'
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_db_queries = 0
+    g.metrics_db_time = 0.0
+    g.metrics_endpoint = endpoint_label()
+    REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def finish_request(exception=None):
+    if 'metrics_started' not in g:
+        return
+    endpoint = g.metrics_endpoint
+    REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+    status = g.get('metrics_status', 500)
+    REQUEST_LATENCY.labels(endpoint, request.method, status).observe(time.perf_counter() - g.metrics_started)
+    DB_QUERIES.labels(endpoint).observe(g.metrics_db_queries)
+    DB_TIME.labels(endpoint).observe(g.metrics_db_time)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'metrics_started' in g:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if started and has_app_context() and 'metrics_started' in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_time += time.perf_counter() - started.pop()
+
+
+def metrics_view():
+    local = request.remote_addr in ('127.0.0.1', '::1')
+    if not local and not (current_user.is_authenticated and
+                          current_user.mod_level >= current_app.config['METRICS_MOD_LEVEL']):
+        abort(404)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
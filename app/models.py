@@ -1,22 +1,24 @@
 from datetime import datetime
 from time import time
-from operator import itemgetter
-from flask import current_app
+from collections import namedtuple
+from flask import current_app, has_app_context
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import json
 import re
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, login, thread_views, reaction_cache, emoji_index, search_outbox
+from app.search import bulk_update, query_index, search_index, search_payload, highlight, SNIPPET_LENGTH
 import os
 import contextlib
 from app.static.markup import melon_markup
 from sqlalchemy.event import listens_for
-from PIL import Image
-from app.static.avatars.random_avatar import random_avatar
+from PIL import Image, ImageSequence, features
+from app.static.avatars.random_avatar import random_avatar, webp_avatar
 from app.static.images.donuts.random_donut import random_donut
-from sqlalchemy.orm import validates
+from sqlalchemy import inspect
+from sqlalchemy.orm import validates, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 
 class User(UserMixin, db.Model):
@@ -47,6 +49,10 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    @property
+    def avatar_webp_path(self):
+        return webp_avatar(self.avatar_path)
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -71,56 +77,53 @@ class User(UserMixin, db.Model):
     def is_thread_viewed(self, thread):
         return UserThreadMetadata.query.filter_by(user=self, thread=thread).count() > 0
 
-    def view_thread(self, thread):
-        # First time viewing thread
-        if not self.is_thread_viewed(thread):
-            utm = UserThreadMetadata(user=self, thread=thread)
-            db.session.add(utm)
-            db.session.commit()
-        # Re-visiting thread; increment view value
-        else:
-            utm = UserThreadMetadata.query.filter_by(user=self, thread=thread).first()
-            utm.user_thread_views += 1
-            db.session.commit()
+    def view_thread(self, thread, last_viewed_timestamp=None):
+        # adds 1 view and, if given, moves the last-read position forward. Both are buffered by thread_views
+        # and written to UserThreadMetadata in bulk
+        thread_views.record(self.id, thread.id, last_viewed_timestamp)
 
     def set_last_viewed_timestamp(self, thread, last_viewed_timestamp):
-        if not self.is_thread_viewed(thread):
-            utm = UserThreadMetadata(
-                user=self, thread=thread,
-                last_viewed_timestamp=last_viewed_timestamp).first()
-            db.session.add(utm)
-            db.session.commit()
-        else:
-            # check if the provided timestamp is more recent than the existing one
-            utm = UserThreadMetadata.query.filter_by(user=self, thread=thread).first()
-
-            # this is needed incase a UserThreadMetadata entry has been made,
-            # but there is no registered last_viewed_timestamp
-            if not utm.last_viewed_timestamp:
-                utm.last_viewed_timestamp = last_viewed_timestamp
-                db.session.commit()
-            # this is a more typical scenario.
-            elif utm.last_viewed_timestamp < last_viewed_timestamp:
-                utm.last_viewed_timestamp = last_viewed_timestamp
-                db.session.commit()
+        # only ever moves forward, see thread_views.newest_timestamp
+        thread_views.record(self.id, thread.id, last_viewed_timestamp, views=0)
 
     def get_user_thread_position(self, thread):
         """return page and post_id based on user's last_viewed_timestamp"""
 
-        if not self.is_thread_viewed(thread):
-            return None, None
         utm = UserThreadMetadata.query.filter_by(user=self, thread=thread).first()
-        if not utm.last_viewed_timestamp:
+        if utm is None or not utm.last_viewed_timestamp:
             return None, None
-        posts = thread.posts.order_by(Post.timestamp.asc()).filter(Post.timestamp <= utm.last_viewed_timestamp).all()
-        if posts:
-            pos = len(posts)  # the number of posts in thread that are older than the user's last-read post timestamp
-            page_num = 1 + int((pos - 1) / current_app.config['POSTS_PER_PAGE'])  # pagenumber
-            post_id = posts[-1].id  # id of the post closest to the user's last-read post timestamp
-            return page_num, post_id
+        # the post closest to the user's last-read post timestamp
+        post = thread.posts.filter(Post.timestamp <= utm.last_viewed_timestamp).order_by(Post.timestamp.desc()).first()
+        if post:
+            return post.page(), post.id
         else:
             return None, None
 
+    def get_thread_read_states(self, threads):
+        """return {thread_id: ThreadReadState} for all of the given threads using a single query.
+        page and post_id point at the first post the user hasn't read yet, if there is one"""
+        read_states = {}
+        thread_ids = [t.id for t in threads]
+        if not thread_ids:
+            return read_states
+
+        last_viewed = UserThreadMetadata.last_viewed_timestamp
+        in_thread = Post.thread_id == Thread.id
+        first_unread = db.select([Post.id]).where(in_thread, Post.timestamp > last_viewed).order_by(
+            Post.timestamp.asc(), Post.id.asc()).limit(1).scalar_subquery()
+        read_count = db.select([db.func.count(Post.id)]).where(in_thread, Post.timestamp <= last_viewed).scalar_subquery()
+        rows = db.session.query(Thread.id, Thread.last_post_at, last_viewed, first_unread, read_count).outerjoin(
+            UserThreadMetadata, db.and_(UserThreadMetadata.thread_id == Thread.id,
+                                        UserThreadMetadata.user_id == self.id)).filter(Thread.id.in_(thread_ids))
+
+        for thread_id, last_post_at, last_viewed_timestamp, first_unread_id, read_count in rows:
+            unread = not (last_viewed_timestamp and last_post_at and last_post_at <= last_viewed_timestamp)
+            page = None
+            if unread and first_unread_id:
+                page = 1 + int((read_count or 0) / current_app.config['POSTS_PER_PAGE'])
+            read_states[thread_id] = ThreadReadState(unread, page, first_unread_id if page else None)
+        return read_states
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -137,6 +140,10 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
 
+# unread is True if the thread has posts newer than the user's last visit. page and post_id locate the first of them
+ThreadReadState = namedtuple('ThreadReadState', ['unread', 'page', 'post_id'])
+
+
 @listens_for(User, 'before_insert')
 def user_defaults(mapper, configuration, target):
     target.avatar_path = random_avatar()
@@ -160,34 +167,64 @@ class SearchableMixin(object):
             db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def models(cls):
+        """the searchable models by index name"""
+        return {model.__tablename__: model for model in cls.__subclasses__()}
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # queue the changes in the same transaction as the changes themselves, the SearchOutboxFlusher sends them
+        if not has_app_context() or not current_app.search_backend:
+            return
+        rows = []
+        now = time()
+        for operation, objs in (('index', session.new), ('index', session.dirty), ('delete', session.deleted)):
+            for obj in objs:
+                if not isinstance(obj, SearchableMixin):
+                    continue
+                if obj in session.dirty and not any(
+                        inspect(obj).attrs[field].history.has_changes() for field in obj.__searchable__):
+                    continue
+                rows.append({'index_name': obj.__tablename__, 'object_id': obj.id, 'operation': operation,
+                             'attempts': 0, 'timestamp': now})
+        if rows:
+            session.connection().execute(SearchOutbox.__table__.insert(), rows)
+            session.info['search_outbox'] = True
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        if session.info.pop('search_outbox', None):
+            search_outbox.notify()
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session.info.pop('search_outbox', None)
+
+    @classmethod
+    def reindex(cls, chunk_size=500):
+        """send every row to the index again, chunk_size rows to a bulk request"""
+        last_id = 0
+        while True:
+            chunk = cls.query.filter(cls.id > last_id).order_by(cls.id.asc()).limit(chunk_size).all()
+            if not chunk:
+                break
+            bulk_update([('index', cls.__tablename__, obj.id, search_payload(obj)) for obj in chunk])
+            last_id = chunk[-1].id
+
+
+class SearchOutbox(db.Model):
+    """changes to searchable rows waiting to be sent to the search backend, see app/search_outbox.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    index_name = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    operation = db.Column(db.String(16))
+    attempts = db.Column(db.Integer, default=0)
+    timestamp = db.Column(db.Float, default=time)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class Post(SearchableMixin, db.Model):
@@ -195,23 +232,45 @@ class Post(SearchableMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(5000))
     body_formatted = db.Column(db.String(10000))
+    markup_version = db.Column(db.Integer)  # melon_markup.VERSION that body_formatted was rendered with
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     thread_id = db.Column(db.Integer, db.ForeignKey('thread.id'))
+    seq = db.Column(db.Integer)  # order of the post within its thread, assigned on insert. Deletes leave gaps
+    version = db.Column(db.Integer, default=0)  # bumped whenever the rendered post changes, see _post.html
     reactions = db.relationship('PostReaction', backref='post', lazy='dynamic')
     edits = db.relationship('EditHistory', backref='original_post', lazy='dynamic')
+    __table_args__ = (db.Index('ix_post_thread_id_seq', 'thread_id', 'seq'),
+                      db.Index('ix_post_thread_id_timestamp', 'thread_id', 'timestamp'),
+                      db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+                      )
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    def position(self):
+        """return the 1-based position of the post in its thread"""
+        if self.seq is None:
+            # not numbered yet, see "flask threads renumber"
+            return db.session.query(db.func.count(Post.id)).filter(
+                Post.thread_id == self.thread_id, Post.id <= self.id).scalar()
+        last_post = self.thread.last_post
+        if last_post is not None and last_post.seq == self.thread.post_count:
+            # nothing has been deleted from the thread, so there are no gaps in the numbering
+            return self.seq
+        # posts that aren't numbered yet are older than any that are
+        return db.session.query(db.func.count(Post.id)).filter(
+            Post.thread_id == self.thread_id, db.or_(Post.seq <= self.seq, Post.seq.is_(None))).scalar()
+
     def page(self):
         if self.thread_id:
-            post_position = len(Post.query.filter_by(thread_id=self.thread_id).filter(Post.id <= self.id).all())
+            post_position = self.position()
             page = int((post_position - 1) / current_app.config['POSTS_PER_PAGE'] + 1)
             return page
 
     def format(self):
         self.body_formatted = melon_markup.parse(self.body)
+        self.markup_version = melon_markup.VERSION
 
     def is_duplicate(self):
         # check the last post by this user in this  thread. If it is <3 s behind and the same text, it is deemed a duplicate
@@ -230,6 +289,7 @@ class Post(SearchableMixin, db.Model):
         history = EditHistory(
             body=self.body,
             body_formatted=self.body_formatted,
+            markup_version=self.markup_version,
             original_post=self,
             editor=editor
         )
@@ -237,6 +297,7 @@ class Post(SearchableMixin, db.Model):
         db.session.commit()
         self.body = new_body
         self.format()
+        self.version = (self.version or 0) + 1
         db.session.commit()
 
     def last_edited(self):
@@ -246,10 +307,113 @@ class Post(SearchableMixin, db.Model):
         else:
             return None
 
+    @staticmethod
+    def views(posts, user):
+        """return a PostView for each of the given posts, loading edit counts and reaction summaries (as seen by user)
+        for all of them at once so that rendering a page of posts doesn't run queries per post. Load the posts with joinedload on Post.author (and
+        Post.thread, if they come from different threads) to avoid a query per post for those as well"""
+        posts = list(posts)
+        post_ids = [post.id for post in posts]
+        edits = {}
+        if post_ids:
+            edits = {row.original_post_id: row for row in db.session.query(
+                EditHistory.original_post_id,
+                db.func.count(EditHistory.id).label('edit_count'),
+                db.func.max(EditHistory.timestamp).label('last_edited')).filter(
+                EditHistory.original_post_id.in_(post_ids)).group_by(EditHistory.original_post_id)}
+        reactions = PostReaction.summaries(post_ids, user)
+
+        views = []
+        for post in posts:
+            edit = edits.get(post.id)
+            views.append(PostView(id=post.id, version=post.version, timestamp=post.timestamp, body_formatted=post.body_formatted,
+                                  author=post.author, thread=post.thread, edit_count=edit.edit_count if edit else 0,
+                                  last_edited=edit.last_edited if edit else None, reactions=reactions[post.id]))
+        return views
+
+    @staticmethod
+    def search_results(expression, page, per_page):
+        """return the page of posts matching expression as SearchResults, best first, and the total number of matches.
+        The page of its thread that each post is on is counted in the same query that loads the posts, rather than with
+        a Post.page() per result"""
+        hits, total = search_index(Post.__tablename__, expression, page, per_page)
+        if not hits:
+            return [], total
+        other = db.aliased(Post)
+        position = db.select([db.func.count(other.id)]).where(
+            other.thread_id == Post.thread_id,
+            db.or_(other.seq <= Post.seq, db.and_(Post.seq.isnot(None), other.seq.is_(None)),
+                   db.and_(Post.seq.is_(None), other.id <= Post.id))).scalar_subquery()
+        rows = db.session.query(Post, position).options(joinedload(Post.author), joinedload(Post.thread)).filter(
+            Post.id.in_([post_id for post_id, snippet in hits]))
+        found = {post.id: (post, position) for post, position in rows}
+
+        results = []
+        for post_id, snippet in hits:
+            if post_id not in found:
+                continue  # deleted, and the search index hasn't caught up yet
+            post, position = found[post_id]
+            if snippet is None:
+                body = post.body or ''
+                snippet = body if len(body) <= SNIPPET_LENGTH else body[:SNIPPET_LENGTH] + '…'
+            page = int((position - 1) / current_app.config['POSTS_PER_PAGE'] + 1) if post.thread_id else None
+            results.append(SearchResult(post=post, thread=post.thread, page=page, snippet=highlight(snippet)))
+        return results, total
+
+
+# one emoji's reactions on a post, as seen by a given user. reacters holds at most REACTERS_SHOWN usernames
+ReactionSummary = namedtuple('ReactionSummary', ['emoji_name', 'small_path', 'count', 'reacted', 'reacters',
+                                                 'small_webp_path'], defaults=(None,))
+
+# everything _post.html needs, see Post.views
+PostView = namedtuple('PostView', ['id', 'version', 'timestamp', 'body_formatted', 'author', 'thread', 'edit_count',
+                                   'last_edited', 'reactions'])
+# a post found by a search, with the page of its thread it is on and the part of it that matched (html), see
+# Post.search_results
+SearchResult = namedtuple('SearchResult', ['post', 'thread', 'page', 'snippet'])
+
 
 @listens_for(Post, 'before_insert')
 def post_defaults(mapper, configuration, target):
     target.body_formatted = melon_markup.parse(target.body)
+    target.markup_version = melon_markup.VERSION
+
+
+@listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, target):
+    """number the post within its thread and keep the thread's post_count, last_post_id and last_post_at up to date
+    without recounting"""
+    if target.thread_id is None:
+        return
+    # this runs once per post after the whole flush has been inserted, so posts added together still get
+    # consecutive numbers
+    post = Post.__table__
+    in_thread = post.c.thread_id == target.thread_id
+    max_seq, = connection.execute(db.select([db.func.max(post.c.seq)]).where(in_thread)).first()
+    seq = (max_seq or 0) + 1
+    # both found with ix_post_thread_id_seq. Only a thread from before posts were numbered has to be counted
+    unnumbered = db.select([post.c.id]).where(in_thread, post.c.seq.is_(None), post.c.id < target.id)
+    if connection.execute(db.select([unnumbered.exists()])).scalar():
+        # older posts of the thread haven't been numbered yet ("flask threads renumber"). They all come before this
+        # one, so it is numbered by its place among them
+        older, = connection.execute(db.select([db.func.count()]).where(in_thread, post.c.id < target.id)).first()
+        seq = max(seq, older + 1)
+    connection.execute(post.update().where(post.c.id == target.id).values(seq=seq))
+    set_committed_value(target, 'seq', seq)
+
+    thread = Thread.__table__
+    is_newest = db.or_(thread.c.last_post_at.is_(None), thread.c.last_post_at <= target.timestamp)
+    connection.execute(thread.update().where(thread.c.id == target.thread_id).values(
+        post_count=db.func.coalesce(thread.c.post_count, 0) + 1,
+        last_post_id=db.case([(is_newest, target.id)], else_=thread.c.last_post_id),
+        last_post_at=db.case([(is_newest, target.timestamp)], else_=thread.c.last_post_at)))
+
+
+@listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, target):
+    if target.thread_id is None:
+        return
+    connection.execute(Thread.recount_statement(target.thread_id))
 
 
 # make edit
@@ -262,6 +426,7 @@ class EditHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(5000))  # holds the pre-edit body, while the Post object gets updated with the new body
     body_formatted = db.Column(db.String(10000))
+    markup_version = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     original_post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
     edited_by = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -275,10 +440,19 @@ class Thread(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     pinned_post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
 
+    # maintained by the Post insert/delete listeners so that listings don't have to count anything.
+    # "flask threads recount" rebuilds them if they ever drift
+    post_count = db.Column(db.Integer, default=0)
+    last_post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='SET NULL'))
+    last_post_at = db.Column(db.DateTime, index=True)
+
     # I can't remember why posts and pinned_post are like this, but there was something conflicting about having two
     # different things being related to post in the normal way, and this solved it.
     posts = db.relationship('Post', backref='thread', primaryjoin=id==Post.thread_id, lazy='dynamic')
     pinned_post = db.relationship('Post', primaryjoin=pinned_post_id==Post.id)
+    __table_args__ = (db.Index('ix_thread_category_id_timestamp', 'category_id', 'timestamp'),
+                      )
+    last_post = db.relationship('Post', primaryjoin=last_post_id==Post.id, viewonly=True)
     users_visited = db.relationship('UserThreadMetadata', backref='thread', lazy='dynamic')
 
     @validates('title')
@@ -292,30 +466,50 @@ class Thread(db.Model):
     def __repr__(self):
         return '<Thread {}>'.format(self.title)
 
-    def post_count(self):
-        count = self.posts.count()
-        return count
+    @staticmethod
+    def recount_statement(thread_id=None):
+        """an UPDATE that recomputes post_count, last_post_id and last_post_at from the post table, either for one
+        thread or, if thread_id is None, for every thread at once"""
+        thread = Thread.__table__
+        post = Post.__table__
+        in_thread = post.c.thread_id == thread.c.id
+        newest = db.select([post.c.id]).where(in_thread).order_by(post.c.timestamp.desc(), post.c.id.desc()).limit(1)
+        statement = thread.update().values(
+            post_count=db.select([db.func.count(post.c.id)]).where(in_thread).scalar_subquery(),
+            last_post_id=newest.scalar_subquery(),
+            last_post_at=db.select([db.func.max(post.c.timestamp)]).where(in_thread).scalar_subquery())
+        if thread_id is not None:
+            statement = statement.where(thread.c.id == thread_id)
+        return statement
 
-    def last_post(self):
-        last_post_in_thread = Post.query.filter_by(thread_id=self.id).order_by(Post.timestamp.desc()).first()
-        return last_post_in_thread
+    @staticmethod
+    def listing_options():
+        """query options that load everything _thread.html needs along with the threads themselves"""
+        return joinedload(Thread.author), joinedload(Thread.last_post).joinedload(Post.author)
 
     def last_page(self):
-        last_page = int((self.posts.count() - 1) / current_app.config['POSTS_PER_PAGE'] + 1)
+        last_page = int(((self.post_count or 0) - 1) / current_app.config['POSTS_PER_PAGE'] + 1)
         return last_page
 
-    def info_icons(self, user):
+    def numbered_without_gaps(self):
+        """whether every post's seq is its position in the thread, so that a page starts at a known seq. That is when
+        nothing has been deleted and the first post has seq 1. Posts that haven't been numbered yet are older than any
+        that have, so if there were any the first post would be one of them"""
+        last_post = self.last_post
+        if last_post is None or last_post.seq != self.post_count:
+            return False
+        return db.session.query(self.posts.filter(Post.seq == 1).exists()).scalar()
+
+    def info_icons(self, user, read_state=None):
+        # listings pass in read_state from User.get_thread_read_states so that it isn't worked out one thread at a time
+        if read_state is None:
+            read_state = user.get_thread_read_states([self])[self.id]
         info_icons = []
 
-        # return dount if there is an unread post for the user
-        page_num, user_last_viewed_post_id = user.get_user_thread_position(self)
-        newest_post = self.last_post()
-        if not user_last_viewed_post_id:
-            donut = random_donut()
-            info_icons.append(donut)
-        elif newest_post and user_last_viewed_post_id:
-            if newest_post.id > user_last_viewed_post_id:
-                donut = random_donut()
+        # return dount if there is an unread post for the user. each thread keeps the same one
+        if read_state.unread:
+            donut = random_donut(self.id)
+            if donut:
                 info_icons.append(donut)
 
         return info_icons
@@ -340,27 +534,48 @@ class Category(db.Model):
         return '<Category {}>'.format(self.title)
 
     def post_count(self):
-        count = sum([t.posts.count() for t in self.threads])
-        return count
+        return Category.post_counts([self])[self.id]
 
     def last_post(self):
-        # Post where Post.thread_id == (Thread where Thread.category_id == self.id).id
-        last_post_in_category = Post.query.join(Thread, Thread.id == Post.thread_id).filter(
+        # the newest last post out of all the threads in this category
+        last_post_in_category = Post.query.join(Thread, Thread.last_post_id == Post.id).filter(
             Thread.category_id == self.id).order_by(
-            Post.timestamp.desc()).first()
+            Thread.last_post_at.desc()).first()
         return last_post_in_category
 
     def active_threads(self, number_of_threads):
-        thread_last_post_times = []
-        for t in self.threads:
-            p = t.last_post()
-            if p is None:
-                thread_last_post_times.append((t, t.timestamp))
-            else:
-                thread_last_post_times.append((t, p.timestamp))
-        sorted_threads = sorted(thread_last_post_times, key=itemgetter(1), reverse=True)
-        sorted_threads = [thread[0] for thread in sorted_threads]
-        return sorted_threads[:number_of_threads]
+        return Category.active_threads_by_category([self], number_of_threads)[self.id]
+
+    @staticmethod
+    def post_counts(categories):
+        """return {category_id: number of posts} for all the given categories with one GROUP BY"""
+        counts = {c.id: 0 for c in categories}
+        rows = db.session.query(Thread.category_id, db.func.sum(Thread.post_count)).filter(
+            Thread.category_id.in_(counts)).group_by(Thread.category_id)
+        for category_id, count in rows:
+            counts[category_id] = count or 0
+        return counts
+
+    @staticmethod
+    def active_threads_by_category(categories, number_of_threads):
+        """return {category_id: [threads]} holding the most recently active threads of each category, all fetched in
+        one query by ranking the threads within their category"""
+        threads_by_category = {c.id: [] for c in categories}
+        if not threads_by_category:
+            return threads_by_category
+
+        # threads without any posts are sorted by their own creation time
+        activity = db.func.coalesce(Thread.last_post_at, Thread.timestamp)
+        ranked = db.session.query(
+            Thread.id.label('thread_id'),
+            db.func.row_number().over(partition_by=Thread.category_id, order_by=activity.desc()).label('rank')
+        ).filter(Thread.category_id.in_(threads_by_category)).subquery()
+
+        threads = Thread.query.options(*Thread.listing_options()).join(ranked, ranked.c.thread_id == Thread.id).filter(
+            ranked.c.rank <= number_of_threads).order_by(Thread.category_id, ranked.c.rank)
+        for thread in threads:
+            threads_by_category[thread.category_id].append(thread)
+        return threads_by_category
 
 
 class UserThreadMetadata(db.Model):
@@ -390,6 +605,42 @@ class PostReaction(db.Model):
     def __repr__(self):
         return '<PostReaction {}>'.format(self.id)
 
+    @staticmethod
+    def summaries(post_ids, user):
+        """return {post_id: [ReactionSummary]} with one entry per emoji, in the order they were first used.
+
+        The grouping doesn't depend on the user, so it is cached per post in reaction_cache and only the posts that
+        aren't cached are loaded, with a single GROUP BY query. Call reaction_cache.invalidate(post_id) after
+        changing a post's reactions"""
+        groups, missing = reaction_cache.get_many(post_ids)
+        if missing:
+            # one row per reaction, grouped here rather than with a string aggregate in SQL, which would need a
+            # separator that can't turn up in a username
+            rows = db.session.query(
+                PostReaction.post_id, Emoji.id, Emoji.name, Emoji.small_path, Emoji.small_webp_path,
+                PostReaction.user_id, User.username
+            ).join(Emoji, Emoji.id == PostReaction.emoji_id).join(User, User.id == PostReaction.user_id).filter(
+                PostReaction.post_id.in_(missing)).order_by(PostReaction.id)
+            grouped = {post_id: {} for post_id in missing}
+            for post_id, emoji_id, name, small_path, small_webp_path, user_id, username in rows:
+                # dicts keep the emojis in the order they were first used
+                group = grouped[post_id].setdefault(emoji_id, [name, small_path, small_webp_path, 0, set(), []])
+                group[3] += 1
+                group[4].add(user_id)
+                group[5].append(username)
+            shown = current_app.config['REACTERS_SHOWN']
+            loaded = {post_id: [(name, small_path, small_webp_path, count, frozenset(user_ids),
+                                 tuple(sorted(usernames, key=str.lower)[:shown]))
+                                for name, small_path, small_webp_path, count, user_ids, usernames in emojis.values()]
+                      for post_id, emojis in grouped.items()}
+            reaction_cache.set_many(loaded)
+            groups.update(loaded)
+
+        user_id = user.id if user else None
+        return {post_id: [ReactionSummary(name, small_path, count, user_id in user_ids, reacters, small_webp_path)
+                          for name, small_path, small_webp_path, count, user_ids, reacters in groups[post_id]]
+                for post_id in post_ids}
+
 
 class Emoji(db.Model):
     # stores reaction images
@@ -397,6 +648,7 @@ class Emoji(db.Model):
     name = db.Column(db.String(15), unique=True)
     file_path = db.Column(db.String(300))
     small_path = db.Column(db.String(300))
+    small_webp_path = db.Column(db.String(300))  # the same as small_path in WebP, for browsers that accept it
     posts = db.relationship('PostReaction', backref='emoji', lazy='dynamic')
 
     def __repr__(self):
@@ -407,58 +659,92 @@ class Emoji(db.Model):
             os.remove(self.file_path)
         db.session.delete(self)
         db.session.commit()
+        reaction_cache.clear()
 
 
 def resize_image(filepath, max_dimension=128, save_path=None):
+    """shrink the image at filepath to fit in max_dimension, keeping every frame of animations. The format is taken
+    from save_path's extension"""
     img = Image.open(filepath)
 
     if save_path is None:
         save_path = filepath
 
-    if img.size[0] > max_dimension and (img.size[0] >= img.size[1]):
-        percent = (max_dimension / float(img.size[0]))
-        height = int((float(img.size[1]) * float(percent)))
-        img = img.resize((max_dimension, height), Image.ANTIALIAS)
-
-    if img.size[1] > max_dimension and img.size[1] > img.size[0]:
-        percent = (max_dimension / float(img.size[1]))
-        width = int((float(img.size[0]) * float(percent)))
-        img = img.resize((width, max_dimension), Image.ANTIALIAS)
-
+    scale = min(1.0, max_dimension / float(max(img.size)))
+    size = (max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale)))
+
+    if getattr(img, 'is_animated', False):
+        frames = []
+        durations = []
+        for frame in ImageSequence.Iterator(img):
+            durations.append(frame.info.get('duration', img.info.get('duration', 100)))
+            frames.append(frame.convert('RGBA').resize(size, Image.LANCZOS))
+        options = {'loop': img.info['loop']} if 'loop' in img.info else {}
+        # disposal 2 clears each frame before the next, or transparent parts would show the previous frames
+        frames[0].save(save_path, save_all=True, append_images=frames[1:], duration=durations, disposal=2, **options)
+        return save_path
+
+    if size != img.size:
+        img = img.resize(size, Image.LANCZOS)
     img.save(save_path)
     return save_path
 
 
+def small_emoji_images(source_path, max_dimension=35):
+    """make the small versions of the emoji image at source_path that reactions are shown with, in its own format and
+    (where Pillow supports it) WebP. Returns their paths, with None for the WebP one if it couldn't be made"""
+    base, extension = os.path.splitext(source_path)
+    small_path = resize_image(source_path, max_dimension=max_dimension, save_path=base + "_s" + extension)
+    webp_path = None
+    if features.check('webp'):
+        webp_path = base + "_s.webp"
+        if webp_path != small_path:
+            resize_image(source_path, max_dimension=max_dimension, save_path=webp_path)
+    return small_path, webp_path
+
+
+@listens_for(Emoji, 'after_insert')
+@listens_for(Emoji, 'after_update')
+@listens_for(Emoji, 'after_delete')
+def emoji_changed(mapper, connection, target):
+    # the emoji index is told once the change has been committed, see emoji_committed
+    db.session.info['emojis_changed'] = True
+
+
+def emoji_committed(session):
+    if session.info.pop('emojis_changed', False):
+        emoji_index.bump()
+
+
+def emoji_rolled_back(session):
+    session.info.pop('emojis_changed', None)
+
+
+db.event.listen(db.session, 'after_commit', emoji_committed)
+db.event.listen(db.session, 'after_rollback', emoji_rolled_back)
+
+
 @listens_for(Emoji, 'before_insert')
 def emoji_defaults(mapper, configuration, target):
-    """upon adding an emoji, automatically resize to 80x80 and store a second file"""
+    """upon adding an emoji, automatically make its small versions"""
+    if target.small_path:
+        # already made, eg. by ingest_emojis
+        return None
     source_path = os.path.join("app", "static", target.file_path)
-    pattern = r"(.+)[.](.+?$)"
-    match = re.match(pattern, source_path)
-    if match is None:
+    if re.match(r"(.+)[.](.+?$)", source_path) is None:
         target.small_path = "filepath not recognized"
         return None
 
-    path_and_name = match.groups()[0]
-    extension = match.groups()[1]
-
-    # don't bother resizing gif at the moment, since by default only one frame is resized and the animation is lost
-    # TODO: implement a way to resize gifs and replace this code
-    if extension == "gif":
+    static_dir = os.path.join(os.getcwd(), "app", "static")
+    try:
+        small_path, webp_path = small_emoji_images(source_path)
+    except (OSError, ValueError):
+        # not an image Pillow can read, show it as it is
         target.small_path = target.file_path
         return None
-
-    # find an _s name that isn't already taken
-    i = 0
-    while True:
-        save_path = path_and_name + "_s" + (str(i) if i > 0 else "") + "." + extension
-        if not os.path.exists(save_path):
-            break
-        i += 1
-
-    save_path = resize_image(source_path, max_dimension=35, save_path=save_path)
-    save_path = os.path.relpath(save_path, os.path.join(os.getcwd(), "app", "static"))
-    target.small_path = save_path.replace("\\", "/")
+    target.small_path = os.path.relpath(small_path, static_dir).replace("\\", "/")
+    if webp_path:
+        target.small_webp_path = os.path.relpath(webp_path, static_dir).replace("\\", "/")
 
 
 class Message(db.Model):
@@ -467,6 +753,8 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),
+                      )
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
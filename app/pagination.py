@@ -0,0 +1,174 @@
+import base64
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from app import db
+
+
+class KeysetPagination(Pagination):
+    """what paginate() returns, but filled in by keyset_paginate. has_next/has_prev come from the cursors rather than
+    from a total, and pages is only known when it was passed in or the page boundaries were looked up"""
+
+    def __init__(self, page, per_page, items, pages, next_cursor, prev_cursor):
+        super(KeysetPagination, self).__init__(None, page, per_page, None, items)
+        self.known_pages = pages
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def pages(self):
+        return self.known_pages or 0
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next and self.page else None
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev and self.page and self.page > 1 else None
+
+
+def keyset_paginate(query, columns, per_page, page=1, cursor=None, descending=False, boundary_key=None, pages=None,
+                    seek=None):
+    """paginate query ordered on columns, a (timestamp, id) pair, without OFFSET or COUNT.
+
+    cursor comes from the next_cursor/prev_cursor of a previous page. Without one, page numbers are turned into a
+    starting row using the cached boundaries of the listing, so page 400 costs the same as page 1. boundary_key must
+    identify the listing, plus anything that changes which rows are on which page (cached boundaries are also dropped
+    after PAGE_BOUNDARY_CACHE_TTL seconds). When pages is not given it is taken from the boundaries.
+
+    seek, when the caller can tell where the page starts without the boundaries, is a filter for the rows from the
+    first row of the page on. It is used instead of the boundaries for page numbers without a cursor"""
+    timestamp, id = columns
+    query = query.order_by(None)
+    seeking = seek is not None and cursor is None and page > 1
+    boundaries = None
+    if boundary_key is not None and (pages is None or (cursor is None and page > 1 and not seeking)):
+        boundaries = page_boundaries(query, columns, per_page, descending, boundary_key)
+        if pages is None:
+            pages = len(boundaries)
+
+    position = decode_cursor(cursor)
+    if position is not None:
+        direction, key = position
+    elif seeking:
+        direction, key = 'from', None
+        query = query.filter(seek)
+    elif page > 1 and boundaries is not None:
+        direction, key = 'from', boundaries[page - 1] if page <= len(boundaries) else None
+        if key is None:
+            return KeysetPagination(page, per_page, [], pages, None, None)
+    else:
+        direction, key = 'from', None
+
+    # walking backwards is the same query in the opposite order, reversed afterwards
+    backwards = direction == 'before'
+    ascending = descending == backwards
+    if key is not None:
+        query = query.filter(after(columns, key, ascending, inclusive=direction == 'from'))
+    if ascending:
+        query = query.order_by(timestamp.asc(), id.asc())
+    else:
+        query = query.order_by(timestamp.desc(), id.desc())
+
+    items = query.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, key is not None or seeking
+
+    if not items:
+        return KeysetPagination(page, per_page, items, pages, None, None)
+    next_cursor = encode_cursor('after', items[-1], columns) if has_next else None
+    prev_cursor = encode_cursor('before', items[0], columns) if has_prev else None
+    return KeysetPagination(page, per_page, items, pages, next_cursor, prev_cursor)
+
+
+def after(columns, key, ascending, inclusive=False):
+    """filter for the rows that come after key in the given order"""
+    timestamp, id = columns
+    key_timestamp, key_id = key
+    if ascending:
+        later, same_time = timestamp > key_timestamp, id >= key_id if inclusive else id > key_id
+    else:
+        later, same_time = timestamp < key_timestamp, id <= key_id if inclusive else id < key_id
+    return db.or_(later, db.and_(timestamp == key_timestamp, same_time))
+
+
+def encode_cursor(direction, item, columns):
+    timestamp, id = (getattr(item, column.key) for column in columns)
+    value = '{}|{}|{}'.format(direction, timestamp.isoformat(), id)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """return (direction, (timestamp, id)), or None for a missing or mangled cursor"""
+    if not cursor:
+        return None
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        direction, timestamp, id = value.split('|')
+        if direction not in ('after', 'before'):
+            return None
+        return direction, (datetime.fromisoformat(timestamp), int(id))
+    except ValueError:
+        return None
+
+
+class BoundaryCache(object):
+    # boundary_key: (expires_at, [(timestamp, id) of the first row of every page])
+    def __init__(self, max_size=1000):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_size = max_size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, boundaries, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, boundaries)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+boundary_cache = BoundaryCache()
+
+
+def page_boundaries(query, columns, per_page, descending, boundary_key):
+    """the (timestamp, id) of the first row of every page, found with one pass over the index and then cached"""
+    key = (boundary_key, per_page, descending)
+    boundaries = boundary_cache.get(key)
+    if boundaries is None:
+        timestamp, id = columns
+        order = (timestamp.desc(), id.desc()) if descending else (timestamp.asc(), id.asc())
+        rows = query.with_entities(timestamp.label('timestamp'), id.label('id'),
+                                   db.func.row_number().over(order_by=order).label('row')).subquery()
+        boundaries = [(row.timestamp, row.id) for row in db.session.query(rows.c.timestamp, rows.c.id).filter(
+            (rows.c.row - 1) % per_page == 0).order_by(rows.c.row)]
+        boundary_cache.set(key, boundaries, current_app.config['PAGE_BOUNDARY_CACHE_TTL'])
+    return boundaries
@@ -0,0 +1,102 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+
+
+class PresenceTracker(object):
+    """Keeps every user's last_seen time in memory and writes the ones that changed to the user table in a single
+    batch every PRESENCE_FLUSH_INTERVAL seconds, instead of committing on every request. The batch is written by a
+    background thread, and once more when the process exits, so requests never wait for it. While testing nothing is
+    written until flush() is called.
+
+    The map only covers requests served by this process, so with several workers online() is each worker's view of
+    who is around. That's fine for a "who's online" list, and the user table is never more than one interval behind."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.last_seen = {}  # user_id: datetime
+        self.flushed = {}  # user_id: the last_seen value that was last written
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.exit_flush_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config['PRESENCE_FLUSH_INTERVAL']
+        self.online_window = timedelta(seconds=app.config['PRESENCE_ONLINE_WINDOW'])
+        self.background = not app.testing
+        if self.background and not self.exit_flush_registered:
+            atexit.register(self.flush_on_exit)
+            self.exit_flush_registered = True
+
+    def seen(self, user_id, now=None):
+        """record a request from user_id. It reaches the database with the next flush"""
+        with self.lock:
+            self.last_seen[user_id] = now or datetime.utcnow()
+        if self.background:
+            self.start_flusher()
+
+    def start_flusher(self):
+        # started on first use rather than in init_app so that each gunicorn worker gets its own thread
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self.run, name='presence-flusher', daemon=True)
+            self.flusher.start()
+
+    def run(self):
+        from app import db
+        while True:
+            time.sleep(self.flush_interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    # whatever wasn't written is still different from what was flushed, so it goes in the next batch
+                    self.app.logger.exception('Failed to flush last_seen times')
+                finally:
+                    db.session.remove()
+
+    def flush_on_exit(self):
+        with self.app.app_context():
+            self.flush()
+
+    def get_last_seen(self, user_id, default=None):
+        return self.last_seen.get(user_id, default)
+
+    def online(self, now=None):
+        """ids of the users seen within PRESENCE_ONLINE_WINDOW, most recent first"""
+        cutoff = (now or datetime.utcnow()) - self.online_window
+        with self.lock:
+            recent = [(seen, user_id) for user_id, seen in self.last_seen.items() if seen >= cutoff]
+            # forget anyone who has been gone for a while so the map doesn't grow forever
+            for user_id, seen in list(self.last_seen.items()):
+                if seen < cutoff and self.flushed.get(user_id) == seen:
+                    del self.last_seen[user_id]
+                    del self.flushed[user_id]
+        return [user_id for seen, user_id in sorted(recent, reverse=True)]
+
+    def flush(self):
+        """write every last_seen that changed since the previous flush with one executemany UPDATE. Returns the number
+        of users written"""
+        from app import db
+        from app.models import User
+        with self.lock:
+            changed = {user_id: seen for user_id, seen in self.last_seen.items()
+                       if self.flushed.get(user_id) != seen}
+        if not changed:
+            return 0
+
+        table = User.__table__
+        update = table.update().where(table.c.id == bindparam('user_id')).values(last_seen=bindparam('seen'))
+        try:
+            db.session.execute(update, [{'user_id': user_id, 'seen': seen} for user_id, seen in changed.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        with self.lock:
+            self.flushed.update(changed)
+        return len(changed)
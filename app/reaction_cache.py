@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReactionCache(object):
+    """Per-process LRU cache of each post's grouped reactions, see PostReaction.summaries.
+
+    Entries are dropped whenever a reaction on the post is added or removed in this process. Other processes only
+    notice once REACTION_CACHE_TTL seconds have passed, so keep it short when running several workers."""
+
+    def __init__(self, app=None):
+        self.entries = OrderedDict()  # post_id: (expires_at, groups)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['REACTION_CACHE_TTL']
+        self.max_size = app.config['REACTION_CACHE_SIZE']
+        self.clear()
+
+    def get_many(self, post_ids):
+        """return ({post_id: groups} for the cached posts, [post ids that have to be loaded])"""
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self.lock:
+            for post_id in post_ids:
+                entry = self.entries.get(post_id)
+                if entry is None or entry[0] < now:
+                    missing.append(post_id)
+                else:
+                    self.entries.move_to_end(post_id)
+                    found[post_id] = entry[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def set_many(self, groups_by_post):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for post_id, groups in groups_by_post.items():
+                self.entries[post_id] = (expires_at, groups)
+                self.entries.move_to_end(post_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, post_id):
+        with self.lock:
+            self.entries.pop(post_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,25 +1,163 @@
+import re
 from flask import current_app
+from markupsafe import Markup, escape
+from elasticsearch.exceptions import ConnectionError, NotFoundError, TransportError
+from app import search_outbox, search_cache
+from app.metrics import SEARCH_CALLS
+
+# The index lives in a backend chosen by SEARCH_BACKEND, kept in app.search_backend. A backend has
+#   bulk_update(changes)                  apply [(operation, index, id, payload)], returning the (index, id) it refused
+#   query(index, query, page, per_page)   the hits on the page, best first, as (id, snippet), and the total number of
+#                                         hits. A snippet is a piece of the row with the words found between
+#                                         HIGHLIGHT_START and HIGHLIGHT_END, or None. Raises SearchUnavailable when
+#                                         the backend can't be reached rather than for a bad query
+#   reset(index)                          empty the index, ready for a rebuild
+#   optimize(index)                       tidy up after a rebuild
+
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+SNIPPET_LENGTH = 160
+# melon markup tags, arguments and all ("[quote,name=bob,post_id=1]"), left out of snippets
+MARKUP_TAG = re.compile(r'\[/?\w+[^\]]*\]')
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def make_backend(app):
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'elasticsearch' and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch, app.config['SEARCH_QUERY_TIMEOUT'],
+                                    app.config['SEARCH_BULK_TIMEOUT'])
+    if backend == 'sqlite':
+        from app.search_sqlite import SQLiteSearchBackend
+        return SQLiteSearchBackend(app.config['SEARCH_SQLITE_PATH'], app.config['SEARCH_BULK_TIMEOUT'],
+                                   app.config['SEARCH_MAX_TOTAL'], app.config['SEARCH_SQLITE_COMMON_HITS'])
+    return None
+
+
+class ElasticsearchBackend(object):
+    def __init__(self, client, query_timeout=2, bulk_timeout=30):
+        self.client = client
+        self.query_timeout = query_timeout
+        self.bulk_timeout = bulk_timeout
+
+    def bulk_update(self, changes):
+        body = []
+        for operation, index, id, payload in changes:
+            body.append({operation: {'_index': index, '_type': index, '_id': id}})
+            if operation == 'index':
+                body.append(payload)
+        response = self.client.bulk(body=body, request_timeout=self.bulk_timeout)
+        failed = set()
+        if response.get('errors'):
+            for item in response['items']:
+                (operation, result), = item.items()
+                status = result.get('status', 500)
+                # deleting something that was never indexed is fine
+                if status >= 300 and not (operation == 'delete' and status == 404):
+                    failed.add((result['_index'], int(result['_id'])))
+        return failed
+
+    def query(self, index, query, page, per_page):
+        try:
+            search = self.client.search(
+                index=index, doc_type=index,
+                body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                      'from': (page - 1) * per_page, 'size': per_page,
+                      'highlight': {'fields': {'*': {}}, 'pre_tags': [HIGHLIGHT_START],
+                                    'post_tags': [HIGHLIGHT_END], 'fragment_size': SNIPPET_LENGTH,
+                                    'number_of_fragments': 1}},
+                request_timeout=self.query_timeout)
+        except TransportError as e:
+            if not isinstance(e, ConnectionError) and isinstance(e.status_code, int) and e.status_code < 500:
+                raise  # a bad query rather than elasticsearch being unwell
+            raise SearchUnavailable(str(e))
+        hits = []
+        for hit in search['hits']['hits']:
+            fragments = [fragment for field in hit.get('highlight', {}).values() for fragment in field]
+            hits.append((int(hit['_id']), fragments[0] if fragments else None))
+        total = search['hits']['total']
+        # elasticsearch 7 gives {'value': n, 'relation': 'eq' or 'gte'}
+        return hits, total['value'] if isinstance(total, dict) else total
+
+    def reset(self, index):
+        try:
+            self.client.indices.delete(index=index)
+        except NotFoundError:
+            pass
+
+    def optimize(self, index):
+        pass
+
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+    bulk_update([('index', index, model.id, search_payload(model))])
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    bulk_update([('delete', index, model.id, None)])
+
+def search_payload(model):
+    return {field: getattr(model, field) for field in model.__searchable__}
+
+def bulk_update(changes):
+    """send [(operation, index, id, payload)] changes, where operation is 'index' or 'delete', in a single batch.
+    Returns the (index, id) pairs the backend turned down. Connection problems are raised"""
+    if not current_app.search_backend or not changes:
+        return set()
+    SEARCH_CALLS.labels('bulk').inc()
+    try:
+        return current_app.search_backend.bulk_update(changes)
+    finally:
+        # even a failed request may have changed some of the index
+        for index in {index for operation, index, id, payload in changes}:
+            search_cache.invalidate(index)
+
+def reset_index(index):
+    """empty the index, ready for a rebuild"""
+    if current_app.search_backend:
+        current_app.search_backend.reset(index)
+    search_cache.invalidate(index)
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    hits, total = search_index(index, query, page, per_page)
+    return [id for id, snippet in hits], total
+
+def search_index(index, query, page, per_page):
+    """the hits on the page as [(id, snippet)], best first, and the total number of hits. They are fetched from the
+    backend a window of SEARCH_CACHE_WINDOW hits at a time and cached, see SearchResultCache"""
+    query = ' '.join(query.lower().split())
+    window = max(search_cache.window, per_page)
+    start = (page - 1) * per_page
+    hits = []
+    total = 0
+    for number in range(start // window, (start + per_page - 1) // window + 1):
+        window_hits, total = query_window(index, query, number, window)
+        hits.extend(window_hits)
+    offset = start - start // window * window
+    return hits[offset:offset + per_page], total
+
+def query_window(index, query, number, size):
+    generation = search_cache.generation(index)
+    cached = search_cache.get(index, (query, number, size))
+    if cached is not None:
+        return cached
+    # while the backend is failing searches come back empty straight away, see SearchOutboxFlusher.breaker
+    if not current_app.search_backend or not search_outbox.breaker.allow():
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
\ No newline at end of file
+    SEARCH_CALLS.labels('query').inc()
+    try:
+        result = current_app.search_backend.query(index, query, number + 1, size)
+    except SearchUnavailable:
+        current_app.logger.exception('Search failed')
+        search_outbox.breaker.record_failure()
+        return [], 0
+    search_outbox.breaker.record_success()
+    search_cache.set(index, (query, number, size), result, generation)
+    return result
+
+def highlight(snippet):
+    """a snippet as html, with the words found in <mark>"""
+    html = escape(MARKUP_TAG.sub('', snippet))
+    return Markup(html.replace(HIGHLIGHT_START, Markup('<mark>')).replace(HIGHLIGHT_END, Markup('</mark>')))
@@ -0,0 +1,55 @@
+import threading
+import time
+from app.fragment_cache import LRUBackend
+
+
+class SearchResultCache(object):
+    """Keeps the ranked hits (with their snippets) and total of recent searches, so that paging through the results of
+    a search, or the same search made again soon after, doesn't go back to the search backend.
+
+    Hits are fetched SEARCH_CACHE_WINDOW at a time and pages are cut out of those windows. Entries last
+    SEARCH_CACHE_TTL seconds, and each index has a generation that sending changes to it bumps (see
+    search.bulk_update), which turns every entry for it into a miss. The cache is per process, so changes sent by
+    another worker's outbox flusher are only seen here once the entries expire, which is why the TTL is short."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['SEARCH_CACHE_TTL']
+        self.window = app.config['SEARCH_CACHE_WINDOW']
+        self.backend = LRUBackend(app.config['SEARCH_CACHE_SIZE']) if self.ttl else None
+
+    def get(self, index, key):
+        if self.backend is None:
+            return None
+        entry = self.backend.get((index, key))
+        if entry is not None:
+            expires, generation, value = entry
+            if expires > time.monotonic() and generation == self.generations.get(index, 0):
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def generation(self, index):
+        return self.generations.get(index, 0)
+
+    def set(self, index, key, value, generation):
+        """store value, worked out while index was at generation. If it has moved on since, the entry is stale already"""
+        if self.backend is not None:
+            self.backend.set((index, key), (time.monotonic() + self.ttl, generation, value))
+
+    def invalidate(self, index):
+        with self.lock:
+            self.generations[index] = self.generations.get(index, 0) + 1
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
@@ -0,0 +1,166 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stops calls to a failing service. After threshold failures in a row it opens and allow() turns everything down
+    for reset_timeout seconds, after which a single call is let through to see whether the service has recovered"""
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # the trial call, anything else has to wait for its result or another reset_timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class SearchOutboxFlusher(object):
+    """Sends the changes queued in the SearchOutbox table to the search backend (see app/search.py).
+
+    Changed posts are written to the outbox in the same transaction as the change itself (see
+    SearchableMixin.after_flush), so nothing is lost when the backend or the process goes away, and committing never
+    waits on search. A thread in each worker drains the outbox every SEARCH_OUTBOX_FLUSH_INTERVAL seconds with bulk
+    requests, only sending the latest change to each object. Indexing and deleting are idempotent, so it doesn't matter
+    if two workers happen to send the same rows.
+
+    When a flush fails the next one is put off for SEARCH_RETRY_BACKOFF seconds, doubling up to SEARCH_RETRY_MAX_BACKOFF.
+    Failures also count towards the circuit breaker that searches share, which turns every call down for
+    SEARCH_BREAKER_RESET seconds once SEARCH_BREAKER_THRESHOLD of them have failed in a row.
+
+    The thread is started by the worker's first request, so that rows left behind by a previous process are sent, or
+    by the first commit that queues something. With SEARCH_OUTBOX_FLUSH_INTERVAL set to 0 no thread is started and the
+    outbox is only sent by "flask search flush"."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.breaker = CircuitBreaker()
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.failures = 0
+        self.flush_interval = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config['SEARCH_OUTBOX_FLUSH_INTERVAL']
+        self.batch_size = app.config['SEARCH_OUTBOX_BATCH_SIZE']
+        self.max_attempts = app.config['SEARCH_OUTBOX_MAX_ATTEMPTS']
+        self.backoff = app.config['SEARCH_RETRY_BACKOFF']
+        self.max_backoff = app.config['SEARCH_RETRY_MAX_BACKOFF']
+        self.breaker = CircuitBreaker(app.config['SEARCH_BREAKER_THRESHOLD'], app.config['SEARCH_BREAKER_RESET'])
+        app.before_request(self.first_request)
+
+    def notify(self):
+        """called after a commit that queued something"""
+        if self.flush_interval:
+            self.start_flusher()
+
+    def first_request(self):
+        # rows a previous process left in the outbox go out without waiting for the next commit that queues something
+        if self.flusher is None and self.flush_interval:
+            self.start_flusher()
+
+    def start_flusher(self):
+        # started on first use rather than in init_app so that each gunicorn worker gets its own thread
+        with self.lock:
+            if self.flusher is None or not self.flusher.is_alive():
+                self.flusher = threading.Thread(target=self.run, name='search-outbox-flusher', daemon=True)
+                self.flusher.start()
+
+    def run(self):
+        from app import db
+        delay = self.flush_interval
+        while True:
+            time.sleep(delay)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                    self.failures = 0
+                    delay = self.flush_interval
+                except Exception:
+                    self.failures += 1
+                    delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+                    self.app.logger.warning('Failed to flush the search outbox, retrying in %.0f s', delay,
+                                            exc_info=True)
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """send everything waiting in the outbox, a batch at a time. Returns the number of outbox rows dealt with,
+        which stops short while the circuit breaker is open"""
+        from app import db
+        from app.models import SearchOutbox, SearchableMixin
+        from app.search import bulk_update, search_payload
+        models = SearchableMixin.models()
+        handled = 0
+        while True:
+            rows = SearchOutbox.query.order_by(SearchOutbox.id.asc()).limit(self.batch_size).all()
+            if not rows or not self.breaker.allow():
+                break
+
+            # only the latest change to each object matters
+            latest = {}
+            for row in rows:
+                latest[(row.index_name, row.object_id)] = row.operation
+            changes = []
+            for index in sorted({index for index, object_id in latest}):
+                model = models.get(index)
+                ids = [object_id for (i, object_id), operation in latest.items() if i == index and operation == 'index']
+                found = {obj.id: obj for obj in model.query.filter(model.id.in_(ids))} if model and ids else {}
+                for (i, object_id), operation in latest.items():
+                    if i != index:
+                        continue
+                    if operation == 'index' and object_id in found:
+                        changes.append(('index', index, object_id, search_payload(found[object_id])))
+                    else:
+                        # deleted since it was queued
+                        changes.append(('delete', index, object_id, None))
+
+            try:
+                failed = bulk_update(changes)
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+
+            done = [row.id for row in rows if (row.index_name, row.object_id) not in failed]
+            retry = [row for row in rows if (row.index_name, row.object_id) in failed]
+            if done:
+                SearchOutbox.query.filter(SearchOutbox.id.in_(done)).delete(synchronize_session=False)
+            for row in retry:
+                row.attempts = (row.attempts or 0) + 1
+                if row.attempts >= self.max_attempts:
+                    self.app.logger.error('Giving up on sending %s %s %s to search after %d attempts',
+                                          row.operation, row.index_name, row.object_id, row.attempts)
+                    db.session.delete(row)
+            db.session.commit()
+            handled += len(done)
+            if len(rows) < self.batch_size or not done:
+                break
+        return handled
@@ -0,0 +1,145 @@
+import re
+import sqlite3
+import threading
+from app.search import SearchUnavailable, HIGHLIGHT_START, HIGHLIGHT_END
+
+# A search index that needs nothing but SQLite: each index is an FTS5 table, search_<index>, in its own database file
+# (SEARCH_SQLITE_PATH), whatever database the rest of the app uses. The rowid is the id of the indexed row, the columns
+# its __searchable__ fields, and hits are ranked with FTS5's built in bm25. Changes reach it through the search outbox
+# like they do for elasticsearch, and "flask search rebuild" fills it from scratch.
+#
+# The file is in WAL mode, so searches are never held up by the outbox flusher of another worker writing to it.
+# Connections are per thread. A ':memory:' path (used by the tests) therefore gives each thread its own empty index.
+
+# words in a snippet, FTS5 allows up to 64
+SNIPPET_WORDS = 24
+
+
+def match_expression(words):
+    """an FTS5 MATCH for rows containing all of words. Each is quoted, anything else in a search would be FTS5 syntax,
+    which people searching the forum don't mean"""
+    return ' '.join('"{}"'.format(word) for word in words)
+
+
+class SQLiteSearchBackend(object):
+    def __init__(self, path, timeout=30, max_total=10000, common_hits=2000):
+        self.path = path
+        self.timeout = timeout
+        # counting every hit of a common word in a large index is slow. Like elasticsearch, stop counting here
+        self.max_total = max_total
+        # bm25 reads through every row containing each word of a search to weigh it, which for a word in a good part
+        # of a million posts takes tens of milliseconds. Words with this many hits still have to match, but are left
+        # out of the ranking (they would count for little in it anyway), see query
+        self.common_hits = common_hits
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit, transactions are begun explicitly
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            if self.path != ':memory:':
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.tables = set()
+        return connection
+
+    def fields(self, index):
+        from app.models import SearchableMixin
+        return SearchableMixin.models()[index].__searchable__
+
+    def table(self, index):
+        """the FTS5 table of index, created the first time it is used"""
+        name = 'search_' + index
+        connection = self.connection
+        if name not in self.local.tables:
+            fields = self.fields(index)
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "{}" USING fts5({}, '
+                               "tokenize='porter unicode61 remove_diacritics 2')".format(name, ', '.join(fields)))
+            self.local.tables.add(name)
+        return name
+
+    def bulk_update(self, changes):
+        connection = self.connection
+        by_index = {}
+        for operation, index, id, payload in changes:
+            by_index.setdefault(index, []).append((operation, id, payload))
+        try:
+            tables = {index: self.table(index) for index in by_index}
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for index, index_changes in by_index.items():
+                    table = tables[index]
+                    connection.executemany('DELETE FROM "{}" WHERE rowid = ?'.format(table),
+                                           [(id,) for operation, id, payload in index_changes])
+                    fields = self.fields(index)
+                    rows = [(id,) + tuple(payload[field] for field in fields)
+                            for operation, id, payload in index_changes if operation == 'index']
+                    if rows:
+                        connection.executemany('INSERT INTO "{}" (rowid, {}) VALUES (?{})'.format(
+                            table, ', '.join(fields), ', ?' * len(fields)), rows)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.OperationalError as e:
+            raise SearchUnavailable(str(e))
+        return set()
+
+    def query(self, index, query, page, per_page):
+        words = re.findall(r'\w+', query)
+        if not words:
+            return [], 0
+        expression = match_expression(words)
+        limit, offset = per_page, (page - 1) * per_page
+        try:
+            table = self.table(index)
+            connection = self.connection
+            ranked = match_expression([word for word in words if self.count(table, '"{}"'.format(word),
+                                                                             self.common_hits) < self.common_hits])
+            # the best few words of the best column, with the words found (the uncommon ones, see below) marked
+            hit = 'SELECT rowid, snippet("{0}", -1, ?, ?, \'…\', {1}) FROM "{0}" '.format(table, SNIPPET_WORDS)
+            marks = (HIGHLIGHT_START, HIGHLIGHT_END)
+            if not ranked:
+                # nothing but common words, which bm25 couldn't tell much apart with anyway. Newest first
+                hits = connection.execute(
+                    hit + 'WHERE "{0}" MATCH ? ORDER BY rowid DESC LIMIT ? OFFSET ?'.format(table),
+                    marks + (expression, limit, offset))
+            elif ranked != expression:
+                # ranked by the uncommon words, among the rows matching all of them
+                hits = connection.execute(
+                    hit + 'WHERE "{0}" MATCH ? AND rowid IN (SELECT rowid FROM "{0}" WHERE "{0}" MATCH ?) '
+                          'ORDER BY rank LIMIT ? OFFSET ?'.format(table),
+                    marks + (ranked, expression, limit, offset))
+            else:
+                # "rank" is bm25()
+                hits = connection.execute(
+                    hit + 'WHERE "{0}" MATCH ? ORDER BY rank LIMIT ? OFFSET ?'.format(table),
+                    marks + (expression, limit, offset))
+            hits = hits.fetchall()
+            if page == 1 and len(hits) < per_page:
+                return hits, len(hits)
+            total = self.count(table, expression, self.max_total)
+        except sqlite3.OperationalError as e:
+            raise SearchUnavailable(str(e))
+        return hits, total
+
+    def count(self, table, expression, limit):
+        """the number of rows matching expression, counting no further than limit"""
+        total, = self.connection.execute(
+            'SELECT count(*) FROM (SELECT 1 FROM "{0}" WHERE "{0}" MATCH ? LIMIT ?)'.format(table),
+            (expression, limit)).fetchone()
+        return total
+
+    def reset(self, index):
+        name = 'search_' + index
+        self.connection.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+        self.local.tables.discard(name)
+        self.table(index)
+
+    def optimize(self, index):
+        # merge the b-trees left by the many small writes of a rebuild into one
+        table = self.table(index)
+        self.connection.execute('INSERT INTO "{0}" ("{0}") VALUES (\'optimize\')'.format(table))
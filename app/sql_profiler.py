@@ -0,0 +1,107 @@
+import random
+import re
+import time
+from collections import Counter
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestProfile(object):
+    """the queries run while handling one request"""
+
+    def __init__(self, slowest=3):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.slowest = []  # (duration, statement), longest first
+        self.keep = slowest
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+        if len(self.slowest) < self.keep or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, statement))
+            self.slowest.sort(key=lambda s: s[0], reverse=True)
+            del self.slowest[self.keep:]
+
+    def repeated(self, threshold):
+        """statement shapes run at least threshold times, most common first. Usually a lazy load inside a loop"""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+def statement_shape(statement):
+    # an expanded IN list has one placeholder per value, so "IN (?, ?)" and "IN (?, ?, ?)" count as the same shape
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return re.sub(r'\((?:\s*(?:\?|%\(\w+\)s|%s)\s*,)+\s*(?:\?|%\(\w+\)s|%s)\s*\)', '(?)', statement)
+
+
+class SQLProfiler(object):
+    """Counts and times the SQL run by a sample of requests, see the SQL_PROFILE_* settings.
+
+    For every sampled request one line is logged with the query count, total database time and the slowest
+    statements, plus a warning for each statement shape repeated at least SQL_PROFILE_REPEAT_THRESHOLD times, which
+    is almost always an N+1. With SQL_PROFILE_SERVER_TIMING the totals are also sent as a Server-Timing header so that
+    they show up in the browser's network panel. Requests that aren't sampled only pay for one random() call."""
+
+    def __init__(self, app=None):
+        self.listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['SQL_PROFILE_SAMPLE_RATE']:
+            return
+        if not self.listening:
+            # the engine is created lazily by flask_sqlalchemy, so listen on every engine and ignore queries that aren't
+            # part of a sampled request
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            self.listening = True
+        app.before_request(start_request)
+        app.after_request(finish_request)
+
+
+def start_request():
+    if random.random() < current_app.config['SQL_PROFILE_SAMPLE_RATE']:
+        g.sql_profile = RequestProfile(current_app.config['SQL_PROFILE_SLOWEST'])
+        g.sql_profile_started = time.perf_counter()
+
+
+def finish_request(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+    elapsed = time.perf_counter() - g.pop('sql_profile_started')
+    config = current_app.config
+
+    current_app.logger.info('%s %s: %d queries, %.1f ms in the database, %.1f ms total. slowest: %s',
+                            request.method, request.full_path.rstrip('?'), profile.count, profile.duration * 1000,
+                            elapsed * 1000, '; '.join('{:.1f} ms {}'.format(duration * 1000, shorten(statement))
+                                                      for duration, statement in profile.slowest))
+    for shape, n in profile.repeated(config['SQL_PROFILE_REPEAT_THRESHOLD']):
+        current_app.logger.warning('%s %s: probable N+1, ran %d times: %s', request.method, request.path, n,
+                                   shorten(shape))
+
+    if config['SQL_PROFILE_SERVER_TIMING']:
+        response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(
+            profile.duration * 1000, profile.count))
+        response.headers.add('Server-Timing', 'app;dur={:.1f}'.format(elapsed * 1000))
+    return response
+
+
+def shorten(statement, length=200):
+    statement = re.sub(r'\s+', ' ', statement)
+    return statement if len(statement) <= length else statement[:length] + '...'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'sql_profile' in g:
+        conn.info.setdefault('sql_profile_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('sql_profile_started')
+    if started and has_app_context() and 'sql_profile' in g:
+        g.sql_profile.record(statement, time.perf_counter() - started.pop())
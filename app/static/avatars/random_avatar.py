@@ -1,38 +1,73 @@
 from PIL import Image
 from random import randint
+import functools
 import os
+import re
+
+# every avatar is one cell of one of the face panels
+PANELS = 8
+COLUMNS = 37
+ROWS = 8
+# the cells are cut out ahead of time by "flask avatars generate", as JPEG and (smaller still) WebP
+CELL_FOLDER = "cells"
+folder_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def cell_path(panel, left, top, extension="jpg"):
+    """the path of a cell from the static folder, numbered from 1 like the old "panel, left, top.bmp" avatars"""
+    return "avatars/{}/{}-{}-{}.{}".format(CELL_FOLDER, panel, left, top, extension)
+
 
 def random_avatar():
-    images = []
-    for i in range(1, 9):
-        images.append(r"face"+str(i)+".jpg")
+    # no image is touched here, the cell was made beforehand
+    return cell_path(randint(1, PANELS), randint(1, COLUMNS), randint(1, ROWS))
+
 
-    rand_panel = randint(0, 7)
-    rand_left = randint(0, 36)
-    rand_top = randint(0, 7)
+def webp_avatar(avatar_path):
+    """the WebP version of a pregenerated avatar, or None for any other path"""
+    if avatar_path and avatar_path.startswith("avatars/{}/".format(CELL_FOLDER)) and avatar_path.endswith(".jpg"):
+        return avatar_path[:-len("jpg")] + "webp"
+    return None
 
-    filename = "{}, {}, {}.bmp".format(rand_panel+1, rand_left+1, rand_top+1)
-    rel_folder_path = os.path.relpath(os.path.dirname(__file__), os.getcwd())
-    rel_save_path = os.path.join(rel_folder_path, "user avatars", filename)
 
-    if os.path.isfile(rel_save_path):
-        return rel_save_path
+def old_avatar_cell(avatar_path):
+    """(panel, left, top) of an avatar made before the cells were pregenerated, or None"""
+    match = re.search(r"(\d+), (\d+), (\d+)\.bmp$", avatar_path or "")
+    return tuple(int(n) for n in match.groups()) if match else None
 
-    source_panel = Image.open(os.path.join(rel_folder_path, images[rand_panel]))
+
+@functools.lru_cache(maxsize=None)
+def load_panel(panel):
+    # each panel is a large jpeg, decoded once per process
+    img = Image.open(os.path.join(folder_path, "face{}.jpg".format(panel)))
+    img.load()
+    return img
+
+
+def crop_cell(panel, left, top):
+    source_panel = load_panel(panel)
     width, height = source_panel.size
-    square_height = height/8
-    square_width = width/37
-
-    left = square_width * rand_left
-    top = square_height * rand_top
-    right = left + square_width
-    bottom = top + square_height
-
-    cropped_image = source_panel.crop((left, top, right, bottom))
-    cropped_image.save(rel_save_path)
-
-    # return relative paths starting from the static folder
-    # these will later be called using "url_for('static', path_to_avatar)"
-    rel_static_path = os.path.relpath(os.path.abspath(rel_save_path), os.path.join(os.getcwd(), "app", "static"))
-    rel_static_path = rel_static_path.replace("\\", "/")
-    return rel_static_path
\ No newline at end of file
+    square_width = width / COLUMNS
+    square_height = height / ROWS
+    x = square_width * (left - 1)
+    y = square_height * (top - 1)
+    return source_panel.crop((x, y, x + square_width, y + square_height))
+
+
+def generate_cells(force=False):
+    """cut out every cell that isn't on disk yet (or all of them with force), returning how many were written"""
+    static_path = os.path.dirname(folder_path)
+    os.makedirs(os.path.join(folder_path, CELL_FOLDER), exist_ok=True)
+    written = 0
+    for panel in range(1, PANELS + 1):
+        for left in range(1, COLUMNS + 1):
+            for top in range(1, ROWS + 1):
+                jpeg = os.path.join(static_path, cell_path(panel, left, top))
+                webp = os.path.join(static_path, cell_path(panel, left, top, "webp"))
+                if not force and os.path.exists(jpeg) and os.path.exists(webp):
+                    continue
+                cell = crop_cell(panel, left, top)
+                cell.save(jpeg, "JPEG", quality=85, optimize=True)
+                cell.save(webp, "WEBP", quality=85, method=6)
+                written += 1
+    return written
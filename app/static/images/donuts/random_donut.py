@@ -1,24 +1,63 @@
 import os
 import random
+import threading
+import time
+import zlib
 
-def random_donut():
-    # TODO: test with folder empty or not existent
 
-    rel_folder_path = os.path.relpath(os.path.dirname(__file__), os.getcwd())
-    rel_folder_path = os.path.join(rel_folder_path, "svg")
-    random_donut = os.path.join(rel_folder_path, random.choice(os.listdir(rel_folder_path)))
-    print(random_donut)
-    # return relative paths starting from the static folder
-    # these will later be called using "url_for('static', path_to_avatar)"
-    rel_static_path = os.path.relpath(os.path.abspath(random_donut), os.path.join(os.getcwd(), "app", "static"))
-    rel_static_path = rel_static_path.replace("\\", "/")
+class DonutCatalog(object):
+    """The donut svgs, listed once per process rather than on every call. The folder is looked at again at most once
+    every check_interval seconds, and only listed again when its mtime has changed"""
 
-    print(rel_static_path)
-    return rel_static_path
+    def __init__(self, folder, static_folder, check_interval=5):
+        self.folder = folder
+        self.static_folder = static_folder
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = None
+        self.donuts = []
+
+    def all(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= self.check_interval:
+            with self.lock:
+                self.checked_at = now
+                try:
+                    mtime = os.stat(self.folder).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    names = []
+                    if mtime is not None:
+                        names = sorted(name for name in os.listdir(self.folder) if name.endswith(".svg"))
+                    # relative to the static folder, for "url_for('static', filename=donut)"
+                    prefix = os.path.relpath(self.folder, self.static_folder).replace("\\", "/")
+                    self.donuts = [prefix + "/" + name for name in names]
+        return self.donuts
+
+    def choose(self, key=None):
+        """the donut for key, which is always the same one as long as the folder doesn't change, so pages showing it
+        can be cached. A random one without a key, or None if there are no donuts"""
+        donuts = self.all()
+        if not donuts:
+            return None
+        if key is None:
+            return random.choice(donuts)
+        return donuts[zlib.crc32(str(key).encode()) % len(donuts)]
+
+
+folder_path = os.path.dirname(os.path.abspath(__file__))
+catalog = DonutCatalog(os.path.join(folder_path, "svg"), os.path.dirname(os.path.dirname(folder_path)))
+
+
+def random_donut(key=None):
+    return catalog.choose(key)
 
 
 # TODO: fix following:
 #  - "010-doughnut.svg" white centre
 #  - "089-donut-75.svg" purple centre
 #  - "083-donut-69.svg" white centre
-#  - "096-donut-79.svg" purple centre
\ No newline at end of file
+#  - "096-donut-79.svg" purple centre
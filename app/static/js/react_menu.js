@@ -1,3 +1,25 @@
+// every emoji (id, name, small_path), loaded once from emoji_manifest_url (see thread.html). The url changes whenever
+// the emoji set does, so the browser keeps it cached and opening, paging and searching the menu needs no requests.
+// Until it has arrived the menu is fetched from the server as before
+var emoji_manifest = null;
+var emojis_by_name = null;
+var EMOJIS_PER_PAGE = 20;
+var BLANK_IMAGE = 'data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7';
+// the small WebP versions are much lighter than animated GIFs, when the browser can show them
+var webp_supported = document.createElement('canvas').toDataURL('image/webp').indexOf('data:image/webp') == 0;
+
+$(document).ready(function() {
+    if (typeof emoji_manifest_url !== 'undefined') {
+        $.getJSON(emoji_manifest_url, function(response) {
+            emoji_manifest = response.emojis;
+            emojis_by_name = emoji_manifest.slice().sort(function(a, b) {
+                var x = a.name.toLowerCase(), y = b.name.toLowerCase();
+                return x < y ? -1 : x > y ? 1 : a.id - b.id;
+            });
+        });
+    }
+});
+
 //create popover menu on reactButton press
 $(document).ready(function() {
     $('[data-toggle="popover"]').popover({
@@ -26,6 +48,9 @@ function react(post_id, reaction_type){
 }
 
 function reaction_menu_page(post_id, page=1) {
+    if (emoji_manifest !== null) {
+        return local_reaction_menu(post_id, parseInt(page));
+    }
     return $.ajax({
         url : "/reaction_menu?page=" + page + "&post_id=" + post_id,
         type : 'GET',
@@ -39,10 +64,84 @@ function change_page(post_id, page=1){
     $('.emojiSearch[post_id="' + post_id + '"]').focus();
 }
 
+// the same markup as _reaction_menu.html and _emoji_grid.html
+function local_reaction_menu(post_id, page) {
+    var pages = Math.ceil(emoji_manifest.length / EMOJIS_PER_PAGE);
+    var start = (page - 1) * EMOJIS_PER_PAGE;
+    var menu = $('<div class="reaction_menu">').attr('post_id', post_id);
+    menu.append($('<input class="emojiSearch">').attr('post_id', post_id));
+    menu.append(emoji_grid(post_id, emoji_manifest.slice(start, start + EMOJIS_PER_PAGE)));
+    if (pages > 1) {
+        var pager = $('<ul class="pager">');
+        $.each(iter_pages(page, pages), function(i, n) {
+            if (n === null) {
+                pager.append($('<span class="ellipsis">').text('. . . '));
+            } else if (n === page) {
+                pager.append($('<li class="page-item">').append($('<strong>').text(n)));
+            } else {
+                var link = $('<a class="page-link" href="#">').text(n).on('click', function() {
+                    change_page(post_id, n);
+                    return false;
+                });
+                pager.append($('<li class="page-item">').append(link));
+            }
+        });
+        menu.append($('<nav aria-label="...">').append(pager));
+    }
+    return menu;
+}
+
+function emoji_grid(post_id, emojis) {
+    var grid = $('<div class="emoji-grid">').attr('post_id', post_id);
+    $.each(emojis, function(i, emoji) {
+        var image = $('<img class="reaction">');
+        if (emoji.sprite) {
+            // drawn from the sprite sheets in emoji_sprite_stylesheet (see base.html)
+            image.addClass(emoji.sprite).attr('src', BLANK_IMAGE);
+        } else {
+            var small_path = webp_supported && emoji.small_webp_path ? emoji.small_webp_path : emoji.small_path;
+            image.attr('src', static_url + small_path);
+        }
+        grid.append($('<div class="reaction_box nopadding">').attr('name', emoji.name)
+            .append($('<a href="javascript:void(0)">').append(image)));
+    });
+    return grid;
+}
+
+// page numbers with gaps (null) like flask_sqlalchemy's Pagination.iter_pages()
+function iter_pages(page, pages) {
+    var numbers = [], last = 0;
+    for (var n = 1; n <= pages; n++) {
+        if (n <= 2 || (n > page - 3 && n < page + 5) || n > pages - 2) {
+            if (last + 1 != n) {
+                numbers.push(null);
+            }
+            numbers.push(n);
+            last = n;
+        }
+    }
+    return numbers;
+}
+
+// names starting with the search, then names containing it, as /search_emojis does
+function local_search(query, limit=20) {
+    query = query.toLowerCase();
+    var starts = [], contains = [];
+    for (var i = 0; i < emojis_by_name.length && starts.length < limit; i++) {
+        var position = emojis_by_name[i].name.toLowerCase().indexOf(query);
+        if (position == 0) {
+            starts.push(emojis_by_name[i]);
+        } else if (position > 0) {
+            contains.push(emojis_by_name[i]);
+        }
+    }
+    return starts.concat(contains).slice(0, limit);
+}
+
 // TODO: would it make more sense to enter stuff into the search bar if the user was focusing any part of the menu?
 //  also, you definitely want it to close if you user presses esc anywhere in the menu. Currently it will only close
 //  if they press esc while specifically in the search bar
-$('.emojiSearch').keyup(function(e) {
+$(document).on('keyup', '.emojiSearch', function(e) {
     clearTimeout($.data(this, 'timer'));
     var post_id = $(this).attr('post_id');
     //submit first result if the user presses enter
@@ -66,6 +165,10 @@ function search(post_id) {
         change_page(post_id);
         return;
     }
+    if (emoji_manifest !== null) {
+        $('.emoji-grid[post_id="' + post_id + '"]').replaceWith(emoji_grid(post_id, local_search(existingString)));
+        return;
+    }
     var reaction_menu = $.ajax({
         url : "/search_emojis?search_string=" + existingString + "&post_id=" + post_id,
         type : 'GET',
@@ -1,108 +1,132 @@
-import json
-import os
-from app.static.markup.tags import tags
-import re
-
-
-class FormatTag():
-    def __init__(self, name, start, end, output_template, format_func):
-        self.name = name
-        self.start = start
-        self.end = end
-        self.format_func = format_func
-        self.output_template = output_template
-        self.openings = []
-
-    def close(self, unformatted, end_pos):
-        if self.openings:
-            pre_text = unformatted[:self.openings[-1]]
-            post_text = unformatted[end_pos + len(self.end):]
-            tagged_text = unformatted[self.openings[-1]: end_pos + len(self.end)]
-            formatted = self.format_func(self, tagged_text)
-            self.openings = self.openings[:-1]
-            return pre_text + formatted + post_text
-        else:
-            return unformatted
-
-
-def create_tags():
-    format_tags = []
-    for t in tags:
-        format_tags.append(FormatTag(name=t['name'], start=t['start'], end=t['end'],
-                                     output_template=t['output_template'], format_func=t['format_func']))
-    return format_tags
-
-
-def parse(s):
-    # the FormatTag class keeps track of information for each tag type, while variables within this function
-    # are responsible for keeping track of inter-tag information and adjusting the tag values based on what happens
-    # as the string is parsed
-    replace = [
-        (u'&', u'&amp;'),
-        (u'<', u'&lt;'),
-        (u'>', u'&gt;'),
-        (u'\n', u'<br/>')
-    ]
-    
-    for r in replace:
-        s = s.replace(r[0], r[1])
-
-    tags = create_tags()
-    open_bracket_pos = None
-    pos = 0
-    while True:
-        if pos >= len(s):
-            return s
-        # encountering end tags
-        elif s[pos:pos + 2] == "[/":
-            tag_identified = False
-            for tag in tags:
-                if s[pos:].startswith(tag.end):
-                    tag_identified = True
-                    if tag.openings:
-                        tag_opening_pos = tag.openings[-1]
-                        len_before = len(s)
-                        s = tag.close(s, pos)
-
-                        # find if any tags were between the start and close of the tag that was just closed
-                        inbetween_tags = False
-                        for _tag in tags:
-                            for i, _tag_opening_pos in enumerate(_tag.openings):
-                                if _tag_opening_pos > tag_opening_pos and _tag_opening_pos < pos:
-                                    inbetween_tags = True
-                                    del _tag.openings[
-                                        i]  # delete in-between tags as their position value is no longer valid
-
-                        if inbetween_tags:
-                            # restart the parser at that the start location of the tag that was closed
-                            pos = tag_opening_pos
-                            break
-
-                        # if there were no tags between, adjust the frame to the ending of this tag pairing)
-                        pos += len(tag.end) + len(s) - len_before
-                        break
-                    else:
-                        # if there is an end tag with no opening tag, skip past it.
-                        pos += len(tag.end)
-                        break
-
-            if not tag_identified:
-                pos += 2
-
-        # encountering the start of opening tags
-        elif s[pos] == "[":
-            open_bracket_pos = pos
-            pos += 1
-        # encountering the end of opening tags
-        elif s[pos] == "]":
-            if open_bracket_pos is not None:
-                possible_start_tag = s[open_bracket_pos:pos + 1]
-                for tag in tags:
-                    if bool(re.match(tag.start, possible_start_tag)):
-                        tag.openings.append(open_bracket_pos)
-                        open_bracket_pos = None
-                        break
-            pos += 1
-        else:
-            pos += 1
-        # print(pos, s[:pos])
\ No newline at end of file
+from app.static.markup.tags import tags
+from app.metrics import MARKUP_RENDERS
+import re
+
+# bump this whenever a change to tags.py changes the html produced for existing posts, so that
+# "flask markup rerender" knows which rows are stale
+VERSION = 1
+
+
+class FormatTag():
+    def __init__(self, name, start, end, output_template, format_func):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.format_func = format_func
+        self.output_template = output_template
+
+    def format(self, tagged_text):
+        return self.format_func(self, tagged_text)
+
+
+class Frame():
+    # an opened tag that hasn't been closed yet. Text that appears after the opening tag is collected in pieces
+    # until the matching end tag shows up, at which point the whole thing is handed to the tag's format_func
+    def __init__(self, tag, start_text):
+        self.tag = tag
+        self.start_text = start_text
+        self.pieces = []
+
+    def raw(self):
+        return self.start_text + "".join(self.pieces)
+
+
+def create_tags():
+    format_tags = []
+    for t in tags:
+        format_tags.append(FormatTag(name=t['name'], start=t['start'], end=t['end'],
+                                     output_template=t['output_template'], format_func=t['format_func']))
+    return format_tags
+
+
+format_tags = create_tags()
+end_tags = {t.end: t for t in format_tags}
+
+# one alternative per start tag, in the same order as the tags table, so the first tag that matches wins
+start_pattern = re.compile("|".join("(?P<t{}>{})".format(i, t.start) for i, t in enumerate(format_tags)))
+
+# end tags are tried before the bare "[/" so that a known end tag is consumed as a whole
+token_pattern = re.compile("|".join(
+    ["(?P<end>{})".format("|".join(re.escape(t.end) for t in format_tags)),
+     r"(?P<slash>\[/)", r"(?P<open>\[)", r"(?P<close>\])"]))
+
+replace = str.maketrans({
+    u'&': u'&amp;',
+    u'<': u'&lt;',
+    u'>': u'&gt;',
+    u'\n': u'<br/>'
+})
+
+
+def parse(s):
+    # the string is tokenized once. Opening tags push a Frame onto the stack, text is appended to whichever frame is
+    # on top, and end tags pop their frame and append the formatted result to the frame below. Nothing is ever
+    # re-scanned unless tags are crossed, ie. [b][i][/b], in which case only the formatted [b] section is fed back
+    # through the tokenizer so that the [i] is picked back up, the same as the old parser did.
+    MARKUP_RENDERS.inc()
+    s = s.translate(replace)
+
+    stack = [Frame(None, "")]
+    open_counts = {t.name: 0 for t in format_tags}
+    pending = [(s, 0)]
+    while pending:
+        s, pos = pending.pop()
+        open_bracket = None  # (index into the top frame's pieces, position in s) of the last "["
+        for m in token_pattern.finditer(s, pos):
+            top = stack[-1]
+            if m.start() > pos:
+                top.pieces.append(s[pos:m.start()])
+            pos = m.end()
+            token = m.group()
+
+            if m.lastgroup == "end":
+                tag = end_tags[token]
+                if not open_counts[tag.name]:
+                    # if there is an end tag with no opening tag, leave it as it is
+                    top.pieces.append(token)
+                    continue
+
+                i = len(stack) - 1
+                while stack[i].tag is not tag:
+                    i -= 1
+                crossed = stack[i + 1:]
+                tagged_text = "".join(frame.raw() for frame in stack[i:]) + token
+                for frame in stack[i:]:
+                    open_counts[frame.tag.name] -= 1
+                del stack[i:]
+                formatted = tag.format(tagged_text)
+                open_bracket = None
+
+                if crossed:
+                    # hand the rest of this string back and re-tokenize the formatted section first
+                    pending.append((s, pos))
+                    pending.append((formatted, 0))
+                    break
+                stack[-1].pieces.append(formatted)
+
+            elif m.lastgroup == "open":
+                open_bracket = (len(top.pieces), m.start())
+                top.pieces.append(token)
+
+            elif m.lastgroup == "close":
+                top.pieces.append(token)
+                if open_bracket is None:
+                    continue
+                piece_index, bracket_pos = open_bracket
+                possible_start_tag = s[bracket_pos:pos]
+                match = start_pattern.match(possible_start_tag)
+                if match:
+                    tag = format_tags[int(match.lastgroup[1:])]
+                    del top.pieces[piece_index:]
+                    stack.append(Frame(tag, possible_start_tag))
+                    open_counts[tag.name] += 1
+                    open_bracket = None
+
+            else:
+                top.pieces.append(token)
+        else:
+            if pos < len(s):
+                stack[-1].pieces.append(s[pos:])
+
+    # anything left open is output as plain text
+    return "".join(frame.raw() for frame in stack)
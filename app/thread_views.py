@@ -0,0 +1,131 @@
+import atexit
+import threading
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+class ThreadViewBuffer(object):
+    """Collects thread views and last-read timestamps in memory and writes them to UserThreadMetadata in bulk, either
+    every THREAD_VIEWS_FLUSH_INTERVAL seconds or as soon as THREAD_VIEWS_FLUSH_SIZE different user/thread pairs are
+    waiting. With THREAD_VIEWS_SYNC (or while testing) every view is written straight away."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.pending = {}  # (user_id, thread_id): [views, last_viewed_timestamp]
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flusher = None
+        self.exit_flush_registered = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.synchronous = app.config['THREAD_VIEWS_SYNC'] or app.testing
+        self.flush_interval = app.config['THREAD_VIEWS_FLUSH_INTERVAL']
+        self.flush_size = app.config['THREAD_VIEWS_FLUSH_SIZE']
+        if not self.synchronous and not self.exit_flush_registered:
+            atexit.register(self.flush_on_exit)
+            self.exit_flush_registered = True
+
+    def record(self, user_id, thread_id, last_viewed_timestamp=None, views=1):
+        key = (user_id, thread_id)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [views, last_viewed_timestamp]
+            else:
+                entry[0] += views
+                if last_viewed_timestamp and (entry[1] is None or last_viewed_timestamp > entry[1]):
+                    entry[1] = last_viewed_timestamp
+            size = len(self.pending)
+
+        if self.synchronous:
+            self.flush()
+            return
+        self.start_flusher()
+        if size >= self.flush_size:
+            self.wakeup.set()
+
+    def start_flusher(self):
+        # started on first use rather than in init_app so that each gunicorn worker gets its own thread
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self.run, name='thread-view-flusher', daemon=True)
+            self.flusher.start()
+
+    def run(self):
+        from app import db
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('Failed to flush thread views')
+                finally:
+                    db.session.remove()
+
+    def flush_on_exit(self):
+        with self.app.app_context():
+            self.flush()
+
+    def flush(self):
+        """write everything that is waiting with one bulk upsert. Returns the number of rows written"""
+        from app import db
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+
+        rows = [{'user_id': user_id, 'thread_id': thread_id, 'user_thread_views': views,
+                 'last_viewed_timestamp': last_viewed_timestamp}
+                for (user_id, thread_id), (views, last_viewed_timestamp) in pending.items()]
+        try:
+            upsert(db, rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self.requeue(pending)
+            raise
+        return len(rows)
+
+    def requeue(self, pending):
+        with self.lock:
+            for (user_id, thread_id), (views, last_viewed_timestamp) in pending.items():
+                entry = self.pending.setdefault((user_id, thread_id), [0, None])
+                entry[0] += views
+                if last_viewed_timestamp and (entry[1] is None or last_viewed_timestamp > entry[1]):
+                    entry[1] = last_viewed_timestamp
+
+
+def upsert(db, rows):
+    from app.models import UserThreadMetadata
+    table = UserThreadMetadata.__table__
+    dialect = db.engine.dialect.name
+
+    if dialect not in ('sqlite', 'postgresql'):
+        # no ON CONFLICT, so fall back to an UPDATE and, if nothing was there yet, an INSERT per row
+        for row in rows:
+            result = db.session.execute(table.update().where(db.and_(
+                table.c.user_id == row['user_id'], table.c.thread_id == row['thread_id'])).values(
+                user_thread_views=table.c.user_thread_views + row['user_thread_views'],
+                last_viewed_timestamp=newest_timestamp(db, table.c.last_viewed_timestamp,
+                                                       row['last_viewed_timestamp'])))
+            if result.rowcount == 0:
+                db.session.execute(table.insert().values(**row))
+        return
+
+    insert = (postgresql if dialect == 'postgresql' else sqlite).insert(table)
+    conflict = {'constraint': '_user_thread_metadata'} if dialect == 'postgresql' \
+        else {'index_elements': ['user_id', 'thread_id']}
+    statement = insert.on_conflict_do_update(set_={
+        'user_thread_views': db.func.coalesce(table.c.user_thread_views, 0) + insert.excluded.user_thread_views,
+        'last_viewed_timestamp': newest_timestamp(db, table.c.last_viewed_timestamp,
+                                                  insert.excluded.last_viewed_timestamp)
+    }, **conflict)
+    db.session.execute(statement, rows)
+
+
+def newest_timestamp(db, existing, new):
+    # keep whichever is more recent, ignoring NULLs on either side
+    return db.case([(db.or_(existing.is_(None), new > existing), new)], else_=existing)
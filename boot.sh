@@ -1,5 +1,9 @@
 #!/bin/sh
 source venv/bin/activate
+# each gunicorn worker writes its metrics here (see app/metrics.py). It has to be emptied before they start
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/melly-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 while true; do
     flask db upgrade
     if [[ "$?" == "0" ]]; then
@@ -8,4 +12,6 @@ while true; do
     echo Upgrade command failed, retrying in 5 secs...
     sleep 5
 done
+# cuts out any avatar images that are missing, new users are given one of these
+flask avatars generate
 exec gunicorn -b :5000 --access-logfile - --error-logfile - melly:app
\ No newline at end of file
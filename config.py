@@ -15,11 +15,83 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # where posts are searched: "elasticsearch", "sqlite" (an FTS5 index in SEARCH_SQLITE_PATH, see app/search_sqlite.py)
+    # or "none". Elasticsearch when ELASTICSEARCH_URL is set, sqlite otherwise
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or ('elasticsearch' if ELASTICSEARCH_URL else 'sqlite')
+    SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH') or os.path.join(basedir, 'search.db')
+    # hits are counted up to here, past it there are "more than" this many results
+    SEARCH_MAX_TOTAL = 10000
+    # words in at least this many posts don't count towards the sqlite ranking, which keeps searches with very common
+    # words fast on a large forum
+    SEARCH_SQLITE_COMMON_HITS = 2000
+    # search results are cached in each process for SEARCH_CACHE_TTL seconds (0 turns the cache off), fetched
+    # SEARCH_CACHE_WINDOW hits at a time so that the next few pages come from the cache too
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 30)
+    SEARCH_CACHE_WINDOW = 100
+    SEARCH_CACHE_SIZE = 1000
+    # changes to searchable rows are queued in the search outbox table and sent in bulk every
+    # SEARCH_OUTBOX_FLUSH_INTERVAL seconds (0 leaves them for "flask search flush"), see app/search_outbox.py
+    SEARCH_OUTBOX_FLUSH_INTERVAL = float(os.environ.get('SEARCH_OUTBOX_FLUSH_INTERVAL') or 2)
+    SEARCH_OUTBOX_BATCH_SIZE = 500
+    # a change elasticsearch keeps turning down is dropped after this many attempts
+    SEARCH_OUTBOX_MAX_ATTEMPTS = 10
+    # seconds before retrying a failed flush, doubled on each failure in a row up to the max
+    SEARCH_RETRY_BACKOFF = 1
+    SEARCH_RETRY_MAX_BACKOFF = 300
+    # after this many failures in a row searches come back empty, without calling elasticsearch, for SEARCH_BREAKER_RESET
+    # seconds
+    SEARCH_BREAKER_THRESHOLD = 5
+    SEARCH_BREAKER_RESET = 30
+    # seconds before a search or a bulk request is given up on
+    SEARCH_QUERY_TIMEOUT = 2
+    SEARCH_BULK_TIMEOUT = 30
     ADMINS = ['lemmyelon@gmail.com']
     POSTS_PER_PAGE = 25
     THREADS_PER_PAGE = 25
     CATEGORIES_PER_PAGE = 25
+    ACTIVE_THREADS_PER_CATEGORY = 5
     UPLOAD_FOLDER = os.path.join(basedir, "app/static/images")
+    # uploaded images, kept under the hash of their contents (see app/image_store.py). It has to be inside app/static
+    IMAGE_STORE_FOLDER = os.environ.get('IMAGE_STORE_FOLDER') or os.path.join(basedir, 'app', 'static', 'images',
+                                                                              'store')
     MAX_NUMBER_OF_EMOJIS = 500
     MAX_EMOJI_SIZE = 367000
+    # threads saving and resizing the files of one emoji upload
+    EMOJI_RESIZE_WORKERS = int(os.environ.get('EMOJI_RESIZE_WORKERS') or min(8, os.cpu_count() or 1))
+    # thread views and read positions are buffered in memory and written in bulk. Set THREAD_VIEWS_SYNC to write
+    # them during the request instead
+    THREAD_VIEWS_SYNC = os.environ.get('THREAD_VIEWS_SYNC') is not None
+    THREAD_VIEWS_FLUSH_INTERVAL = float(os.environ.get('THREAD_VIEWS_FLUSH_INTERVAL') or 5)
+    THREAD_VIEWS_FLUSH_SIZE = 500
+    # last_seen is tracked in memory and written to the user table by a background thread once per interval.
+    # Anyone seen within the online window shows up as online
+    PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL') or 60)
+    PRESENCE_ONLINE_WINDOW = 300
+    # grouped reactions are cached per post in each process. Another process's changes show up after the TTL
+    REACTION_CACHE_TTL = float(os.environ.get('REACTION_CACHE_TTL') or 30)
+    REACTION_CACHE_SIZE = 10000
+    REACTERS_SHOWN = 10
+    # listings page with cursors, page numbers are looked up from cached page boundaries
+    PAGE_BOUNDARY_CACHE_TTL = 300
+    # fraction of requests whose queries are counted, timed and logged, 0 to turn it off. Statement shapes repeated
+    # SQL_PROFILE_REPEAT_THRESHOLD times in one request are logged as probable N+1s
+    SQL_PROFILE_SAMPLE_RATE = float(os.environ.get('SQL_PROFILE_SAMPLE_RATE') or 0)
+    SQL_PROFILE_SERVER_TIMING = os.environ.get('SQL_PROFILE_SERVER_TIMING') is not None
+    SQL_PROFILE_REPEAT_THRESHOLD = 5
+    SQL_PROFILE_SLOWEST = 3
+    # /metrics is served to local requests and to users with at least this mod level
+    METRICS_MOD_LEVEL = 2
+    # rendered post fragments are cached in 'lru' (this process only), 'filesystem' or 'redis' (shared by every
+    # worker). Empty to turn it off
+    FRAGMENT_CACHE = os.environ.get('FRAGMENT_CACHE', 'lru')
+    FRAGMENT_CACHE_SIZE = 5000
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR') or os.path.join(basedir, 'cache', 'fragments')
+    FRAGMENT_CACHE_REDIS_URL = os.environ.get('FRAGMENT_CACHE_REDIS_URL') or 'redis://localhost:6379/0'
+    FRAGMENT_CACHE_TTL = 24 * 60 * 60
+    # rewritten whenever emojis change so that every worker knows to reload its emoji index
+    EMOJI_INDEX_STAMP = os.environ.get('EMOJI_INDEX_STAMP') or os.path.join(basedir, 'cache', 'emoji_index.stamp')
+    # the reaction sprite sheets and their stylesheet are written here, it has to be inside app/static. Set it to an
+    # empty string to show every emoji from its own file
+    EMOJI_SPRITE_FOLDER = os.environ.get('EMOJI_SPRITE_FOLDER', os.path.join(basedir, 'app', 'static', 'images',
+                                                                             'sprites'))
     ADMINS = ['lemmyelon@gmail.com']
\ No newline at end of file
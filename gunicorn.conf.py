@@ -0,0 +1,8 @@
+import os
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # drop the gauges of workers that have gone away, see app/metrics.py
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,7 +1,8 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Post, Thread, Category, UserThreadMetadata, Message, Notification, PostReaction, Emoji, EditHistory
 
 app = create_app()
+cli.register(app)
 
 
 @app.shell_context_processor
@@ -1,13 +1,65 @@
 from datetime import datetime, timedelta
+import io
+import json
+import os
+import re
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+from flask import Flask, g
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import create_app, db, cli, thread_views, reaction_cache, emoji_index, emoji_sprites, search_outbox, \
+    search_cache, fragment_cache
+from app.presence import PresenceTracker
+from app.pagination import keyset_paginate, boundary_cache
+from app.sql_profiler import RequestProfile
+from app.metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, DB_QUERIES, DB_TIME
+from app.fragment_cache import FragmentCache, LRUBackend, templates_digest
+from app.emoji_upload import ingest_emojis
+from app.emoji_index import small_image
+from app.emoji_sprites import EmojiSprites
+from app.search import ElasticsearchBackend, reset_index
+from app.models import User, Post, Thread, Category, UserThreadMetadata, PostReaction, Emoji, \
+    ReactionSummary, SearchOutbox
+from app.static.markup import melon_markup
+from app.static.avatars import random_avatar
+from app.static.images.donuts.random_donut import DonutCatalog
 from config import Config
+from PIL import Image
+from prometheus_client import REGISTRY, values
+from werkzeug.datastructures import FileStorage
+from elasticsearch.exceptions import ConnectionError as SearchConnectionError
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    EMOJI_INDEX_STAMP = os.path.join(tempfile.gettempdir(), 'melly-tests', 'emoji_index.stamp')
+    EMOJI_SPRITE_FOLDER = os.path.join(tempfile.gettempdir(), 'melly-tests', 'sprites')
+    SEARCH_OUTBOX_FLUSH_INTERVAL = 0
+    SEARCH_SQLITE_PATH = ':memory:'
+
+
+class ProfiledConfig(TestConfig):
+    SQL_PROFILE_SAMPLE_RATE = 1
+
+
+def profile_requests(app):
+    """keep the RequestProfile of every request app handles in the list returned, see sql_profiler"""
+    profiles = []
+
+    @app.after_request
+    def keep_profile(response):
+        profiles.append(g.sql_profile)
+        return response
+    return profiles
+
+
+def log_in(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
 
 
 class UserModelCase(unittest.TestCase):
@@ -34,6 +86,15 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_pregenerated_avatar(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertRegex(u.avatar_path, r'^avatars/cells/[1-8]-\d+-[1-8]\.jpg$')
+        self.assertEqual(u.avatar_webp_path, u.avatar_path[:-3] + 'webp')
+        self.assertEqual(random_avatar.old_avatar_cell('avatars/user avatars/3, 21, 5.bmp'), (3, 21, 5))
+        self.assertEqual(random_avatar.crop_cell(8, 37, 8).size, random_avatar.crop_cell(1, 1, 1).size)
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -96,5 +157,924 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class PresenceCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_presence(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        presence = PresenceTracker(self.app)
+        start = datetime(2021, 1, 1)
+
+        # requests only touch the map, the flush writes everyone who changed in one go
+        presence.seen(u1.id, start)
+        presence.seen(u2.id, start + timedelta(seconds=20))
+        self.assertNotEqual(User.query.get(u1.id).last_seen, start)
+        self.assertEqual(presence.get_last_seen(u1.id), start)
+        self.assertEqual(presence.flush(), 2)
+        self.assertEqual(User.query.get(u1.id).last_seen, start)
+        self.assertEqual(User.query.get(u2.id).last_seen, start + timedelta(seconds=20))
+        self.assertEqual(presence.flush(), 0)
+
+        # a batch that fails is written by the next flush
+        later = start + timedelta(seconds=self.app.config['PRESENCE_FLUSH_INTERVAL'])
+        presence.seen(u1.id, later)
+        with mock.patch.object(db.session, 'execute', side_effect=OperationalError('UPDATE', {}, None)):
+            self.assertRaises(OperationalError, presence.flush)
+        self.assertEqual(presence.flush(), 1)
+        self.assertEqual(User.query.get(u1.id).last_seen, later)
+
+        self.assertEqual(presence.online(later), [u1.id, u2.id])
+        self.assertEqual(presence.online(later + timedelta(seconds=self.app.config['PRESENCE_ONLINE_WINDOW'])),
+                         [u1.id])
+
+
+class ThreadCountersCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_counters_follow_inserts_and_deletes(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body='first', thread=t, timestamp=now)
+        p2 = Post(body='second', thread=t, timestamp=now + timedelta(seconds=2))
+        p3 = Post(body='backdated', thread=t, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(t.post_count, 3)
+        self.assertEqual(t.last_post, p2)
+
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(t.post_count, 2)
+        self.assertEqual(t.last_post, p3)
+
+    def test_recount(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.add(Post(body='first', thread=t))
+        db.session.commit()
+        t.post_count = 7
+        t.last_post_id = None
+        db.session.commit()
+        db.session.execute(Thread.recount_statement())
+        db.session.commit()
+        self.assertEqual(t.post_count, 1)
+        self.assertEqual(t.last_post, t.posts.first())
+
+    def test_post_positions(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        posts = [Post(body=str(i), thread=t) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual([p.seq for p in posts], [1, 2, 3, 4])
+        self.assertEqual([p.position() for p in posts], [1, 2, 3, 4])
+
+        # numbering a post in a thread that is numbered already doesn't count the posts before it
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement.lower())
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            db.session.add(Post(body='new', thread=t))
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(t.posts.order_by(Post.id.desc()).first().seq, 5)
+        self.assertEqual([s for s in statements if 'count(' in s], [])
+
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(posts[3].seq, 4)
+        self.assertEqual(posts[3].position(), 3)
+
+    def test_post_positions_before_renumbering(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        old = [Post(body=str(i), thread=t) for i in range(3)]
+        db.session.add_all(old)
+        db.session.commit()
+        # posts from before they were numbered
+        Post.query.update({'seq': None}, synchronize_session=False)
+        db.session.commit()
+
+        new = [Post(body='new', thread=t), Post(body='newer', thread=t)]
+        for p in new:
+            db.session.add(p)
+            db.session.commit()
+        self.assertEqual([p.seq for p in new], [4, 5])
+        self.assertEqual([p.page() for p in new], [2, 3])
+        db.session.delete(old[0])
+        db.session.commit()
+        self.assertEqual([p.position() for p in new], [3, 4])
+        self.assertEqual(Post.query.get(old[2].id).position(), 2)
+
+    def test_thread_read_states(self):
+        self.app.config['POSTS_PER_PAGE'] = 2
+        u = User(id=1, username='john')
+        read, unread, unseen = Thread(title='read'), Thread(title='unread'), Thread(title='unseen')
+        db.session.add_all([read, unread, unseen])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Post(body=str(i), thread=unread, timestamp=now + timedelta(seconds=i)) for i in range(4)]
+        db.session.add_all(posts + [Post(body='r', thread=read, timestamp=now),
+                                    Post(body='s', thread=unseen, timestamp=now)])
+        db.session.add_all([
+            UserThreadMetadata(user_id=u.id, thread=read, last_viewed_timestamp=now),
+            UserThreadMetadata(user_id=u.id, thread=unread, last_viewed_timestamp=posts[1].timestamp)])
+        db.session.commit()
+
+        states = u.get_thread_read_states([read, unread, unseen])
+        self.assertFalse(states[read.id].unread)
+        self.assertEqual(states[unread.id], (True, 2, posts[2].id))
+        self.assertTrue(states[unseen.id].unread)
+
+    def test_thread_views(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        now = datetime.utcnow()
+        thread_views.record(1, t.id, now)
+        thread_views.record(1, t.id, now - timedelta(seconds=5))
+        thread_views.record(1, t.id)
+        utm = UserThreadMetadata.query.filter_by(user_id=1, thread_id=t.id).one()
+        self.assertEqual(utm.user_thread_views, 3)
+        self.assertEqual(utm.last_viewed_timestamp, now)
+
+    def test_category_aggregates(self):
+        c1 = Category(title='one')
+        c2 = Category(title='two')
+        now = datetime.utcnow()
+        quiet = Thread(title='quiet', category=c1, timestamp=now)
+        busy = Thread(title='busy', category=c1, timestamp=now)
+        empty = Thread(title='empty', category=c1, timestamp=now + timedelta(seconds=5))
+        other = Thread(title='other', category=c2, timestamp=now)
+        db.session.add_all([c1, c2, quiet, busy, empty, other])
+        db.session.commit()
+        db.session.add_all([
+            Post(body='a', thread=quiet, timestamp=now + timedelta(seconds=1)),
+            Post(body='b', thread=busy, timestamp=now + timedelta(seconds=2)),
+            Post(body='c', thread=busy, timestamp=now + timedelta(seconds=10)),
+            Post(body='d', thread=other, timestamp=now + timedelta(seconds=3))])
+        db.session.commit()
+
+        active = Category.active_threads_by_category([c1, c2], 2)
+        self.assertEqual(active[c1.id], [busy, empty])
+        self.assertEqual(active[c2.id], [other])
+        self.assertEqual(Category.post_counts([c1, c2]), {c1.id: 3, c2.id: 1})
+        self.assertEqual(c1.last_post().body, 'c')
+
+
+class PostViewsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(ProfiledConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.profiles = profile_requests(self.app)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_views(self):
+        u = User(username='john', email='john@example.com')
+        e = Emoji(name='melon', file_path='melon')
+        t = Thread(title='thread')
+        db.session.add_all([u, e, t])
+        db.session.commit()
+        p1 = Post(body='first', thread=t, author=u)
+        p2 = Post(body='second', thread=t, author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        db.session.add(PostReaction(post=p2, user=u, emoji=e))
+        db.session.commit()
+        p1.edit('first, edited', u)
+
+        v1, v2 = Post.views([p1, p2], u)
+        self.assertEqual((v1.id, v1.author, v1.edit_count, v1.reactions), (p1.id, u, 1, []))
+        self.assertEqual(v1.last_edited, p1.last_edited())
+        self.assertEqual((v2.edit_count, v2.last_edited), (0, None))
+        self.assertEqual(v2.reactions, [ReactionSummary('melon', e.small_path, 1, True, ('john',))])
+
+    def test_reaction_summaries(self):
+        users = [User(username=name, email=name) for name in ['amy', 'Bob', 'cat']]
+        e1 = Emoji(name='melon', file_path='melon')
+        e2 = Emoji(name='lemon', file_path='lemon')
+        t = Thread(title='thread')
+        db.session.add_all(users + [e1, e2, t])
+        db.session.commit()
+        p = Post(body='post', thread=t)
+        db.session.add(p)
+        db.session.commit()
+        db.session.add_all([PostReaction(post=p, user=users[2], emoji=e2)] +
+                           [PostReaction(post=p, user=u, emoji=e1) for u in users])
+        db.session.commit()
+
+        summaries = PostReaction.summaries([p.id], users[0])[p.id]
+        self.assertEqual([(s.emoji_name, s.count, s.reacted, s.reacters) for s in summaries],
+                         [('lemon', 1, False, ('cat',)), ('melon', 3, True, ('amy', 'Bob', 'cat'))])
+
+        # served from the cache until it is invalidated
+        db.session.add(PostReaction(post=p, user=users[0], emoji=e2))
+        db.session.commit()
+        self.assertEqual(PostReaction.summaries([p.id], users[0])[p.id][0].count, 1)
+        reaction_cache.invalidate(p.id)
+        lemon = PostReaction.summaries([p.id], users[0])[p.id][0]
+        self.assertEqual((lemon.count, lemon.reacted, lemon.reacters), (2, True, ('amy', 'cat')))
+
+    def test_reaction_summaries_with_commas_in_usernames(self):
+        users = [User(username=name, email=name) for name in ['smith, john', 'zed']]
+        e = Emoji(name='melon', file_path='melon')
+        p = Post(body='post')
+        db.session.add_all(users + [e, p])
+        db.session.commit()
+        db.session.add_all([PostReaction(post=p, user=u, emoji=e) for u in users])
+        db.session.commit()
+        melon, = PostReaction.summaries([p.id], users[1])[p.id]
+        self.assertEqual((melon.count, melon.reacted, melon.reacters), (2, True, ('smith, john', 'zed')))
+
+    def test_thread_page_queries(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(5)]
+        emojis = [Emoji(name='melon', file_path='melon'), Emoji(name='lemon', file_path='lemon')]
+        small, large = Thread(title='small'), Thread(title='large')
+        db.session.add_all(users + emojis + [small, large])
+        db.session.commit()
+        for thread, count in ((small, 2), (large, 20)):
+            posts = [Post(body='[b]post {}[/b]'.format(i), thread=thread, author=users[i % len(users)])
+                     for i in range(count)]
+            db.session.add_all(posts)
+            db.session.commit()
+            db.session.add_all([PostReaction(post=p, user=u, emoji=e)
+                                for p in posts for u in users[:3] for e in emojis])
+            db.session.commit()
+            posts[-1].edit('edited', users[0])
+        client = self.app.test_client()
+        log_in(client, users[0])
+
+        # the same number of queries however many posts, authors, reactions and edits are on the page
+        counts = []
+        for thread in (small, large):
+            self.assertEqual(client.get('/thread/{}?page=1'.format(thread.id)).status_code, 200)
+            profile = self.profiles[-1]
+            self.assertEqual(profile.repeated(3), [])
+            counts.append(profile.count)
+        self.assertEqual(counts[0], counts[1])
+
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(ProfiledConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.profiles = profile_requests(self.app)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_keyset_pagination(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        now = datetime.utcnow()
+        # a few posts share a timestamp so that ties have to be broken on id
+        db.session.add_all([Post(body=str(i), thread=t, timestamp=now + timedelta(seconds=i // 3)) for i in range(11)])
+        db.session.commit()
+        expected = [p.id for p in t.posts.order_by(Post.timestamp.asc(), Post.id.asc())]
+
+        def paginate(**kwargs):
+            return keyset_paginate(t.posts, (Post.timestamp, Post.id), 4, boundary_key=('test', t.id), **kwargs)
+
+        pages = [paginate(page=1)]
+        while pages[-1].has_next:
+            pages.append(paginate(page=pages[-1].next_num, cursor=pages[-1].next_cursor))
+        self.assertEqual([[p.id for p in page.items] for page in pages],
+                         [expected[0:4], expected[4:8], expected[8:11]])
+        self.assertEqual(pages[0].pages, 3)
+        self.assertFalse(pages[0].has_prev)
+
+        # page numbers without a cursor and walking backwards give the same pages
+        self.assertEqual([p.id for p in paginate(page=2).items], expected[4:8])
+        back = paginate(page=2, cursor=pages[2].prev_cursor)
+        self.assertEqual([p.id for p in back.items], expected[4:8])
+        self.assertTrue(back.has_prev)
+        self.assertEqual(paginate(page=9).items, [])
+
+    def test_keyset_pagination_by_seq(self):
+        t = Thread(title='thread')
+        db.session.add(t)
+        db.session.commit()
+        now = datetime.utcnow()
+        db.session.add_all([Post(body=str(i), thread=t, timestamp=now + timedelta(seconds=i)) for i in range(11)])
+        db.session.commit()
+        expected = [p.id for p in t.posts.order_by(Post.timestamp.asc(), Post.id.asc())]
+        self.assertTrue(t.numbered_without_gaps())
+
+        # the page starts at a seq, so the boundaries are never looked up
+        boundary_key = ('seq test', t.id)
+        page = keyset_paginate(t.posts, (Post.timestamp, Post.id), 4, page=2, seek=Post.seq > 4,
+                               boundary_key=boundary_key, pages=t.last_page())
+        self.assertEqual([p.id for p in page.items], expected[4:8])
+        self.assertTrue(page.has_prev)
+        self.assertTrue(page.has_next)
+        self.assertIsNone(boundary_cache.get((boundary_key, 4, False)))
+
+        # seqs stop being positions once a post is deleted
+        db.session.delete(t.posts.filter_by(seq=6).first())
+        db.session.commit()
+        self.assertFalse(t.numbered_without_gaps())
+
+        # or while older posts haven't been numbered yet, even though the newer ones are numbered by their place
+        t2 = Thread(title='unnumbered')
+        db.session.add_all([t2] + [Post(body=str(i), thread=t2, timestamp=now + timedelta(seconds=i))
+                                   for i in range(3)])
+        db.session.commit()
+        Post.query.filter(Post.thread_id == t2.id).update({'seq': None})
+        db.session.add(Post(body='new', thread=t2, timestamp=now + timedelta(seconds=20)))
+        db.session.commit()
+        self.assertEqual(t2.last_post.seq, t2.post_count)
+        self.assertFalse(t2.numbered_without_gaps())
+
+    def test_listing_pages_without_counting(self):
+        self.app.config['THREADS_PER_PAGE'] = 2
+        self.app.config['POSTS_PER_PAGE'] = 2
+        u = User(username='john', email='john@example.com')
+        c = Category(title='category')
+        now = datetime.utcnow()
+        threads = [Thread(title='thread {}'.format(i), category=c, timestamp=now + timedelta(seconds=i))
+                   for i in range(7)]
+        db.session.add_all([u, c] + threads)
+        db.session.commit()
+        db.session.add_all([Post(body='post {}'.format(i), thread=t, author=u, timestamp=t.timestamp)
+                            for i, t in enumerate(threads)])
+        db.session.commit()
+        client = self.app.test_client()
+        log_in(client, u)
+
+        views = [('/cat/{}?page=3'.format(c.id), 'thread.category_id', ['thread 4', 'thread 5']),
+                 ('/user/john?page=3', 'post.user_id', ['post 2', 'post 1'])]
+        for url, listing, expected in views:
+            # the first view looks up the page boundaries, the next ones only read the page
+            for i in range(3):
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+                for text in expected:
+                    self.assertIn(text, response.get_data(as_text=True))
+                statements = [s.lower() for s in self.profiles[-1].shapes if listing in s]
+                self.assertEqual([s for s in statements if 'count(' in s], [])
+                self.assertEqual(any('row_number(' in s for s in statements), i == 0)
+
+
+class EmojiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_emoji_index(self):
+        db.session.add_all([Emoji(name=name, file_path=name) for name in ['melon', 'Lemon', 'watermelon', 'mellow']])
+        db.session.commit()
+        names = lambda results: [emoji.name for emoji in results]
+        self.assertEqual(names(emoji_index.search('mel')), ['mellow', 'melon', 'watermelon'])
+        self.assertEqual(names(emoji_index.search('lemon')), ['Lemon'])
+        self.assertEqual(names(emoji_index.search('watremelon')), ['watermelon'])
+        self.assertEqual(emoji_index.count(), 4)
+
+        # renames and deletes are picked up without anything having to tell the index directly
+        Emoji.query.filter_by(name='mellow').first().name = 'yellow'
+        db.session.delete(Emoji.query.filter_by(name='watermelon').first())
+        db.session.commit()
+        self.assertEqual(names(emoji_index.search('mel', fuzzy=False)), ['melon'])
+        self.assertEqual(names(emoji_index.search('ello', fuzzy=False)), ['yellow'])
+
+        # the manifest, and so its url, only changes along with the emojis
+        digest, body = emoji_index.manifest()
+        self.assertEqual([e['name'] for e in json.loads(body)['emojis']], ['melon', 'Lemon', 'yellow'])
+        self.assertEqual(emoji_index.manifest()[0], digest)
+        db.session.add(Emoji(name='honeydew', file_path='honeydew'))
+        db.session.commit()
+        self.assertNotEqual(emoji_index.manifest()[0], digest)
+
+    def test_ingest_emojis(self):
+        self.app.config['IMAGE_STORE_FOLDER'] = tempfile.mkdtemp()
+        self.app.config['MAX_EMOJI_SIZE'] = 5000
+
+        def png(colour, size=(64, 64)):
+            data = io.BytesIO()
+            Image.new('RGB', size, colour).save(data, 'PNG')
+            return data.getvalue()
+
+        db.session.add(Emoji(name='emoji_1', file_path='melon'))
+        db.session.commit()
+        files = [FileStorage(io.BytesIO(data), filename) for filename, data in [
+            ('red.png', png('red')), ('notes.txt', b'hello'), ('again.png', png('red')),
+            ('big.png', os.urandom(6000)), ('broken.png', b'not an image'), ('blue.png', png('blue'))]]
+        results = ingest_emojis(files)
+        self.assertEqual([(r.filename, r.saved) for r in results], [
+            ('red.png', True), ('notes.txt', False), ('again.png', False), ('big.png', False),
+            ('broken.png', False), ('blue.png', True)])
+        self.assertEqual([r.emoji_name for r in results if r.saved], ['emoji_2', 'emoji_3'])
+
+        emoji = Emoji.query.filter_by(name='emoji_2').first()
+        self.assertRegex(emoji.file_path, r'/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}\.png$')
+        static_dir = os.path.join(self.app.root_path, 'static')
+        self.assertEqual(Image.open(os.path.join(static_dir, emoji.small_path)).size, (35, 35))
+        self.assertEqual(ingest_emojis([FileStorage(io.BytesIO(png('red')), 'red.png')])[0].message,
+                         'duplicate of an existing emoji')
+
+        # animations keep their frames when shrunk, in both the original format and WebP
+        frames = [Image.new('RGB', (70, 70), colour) for colour in ('red', 'green', 'blue')]
+        gif = io.BytesIO()
+        frames[0].save(gif, 'GIF', save_all=True, append_images=frames[1:], duration=100, loop=0)
+        self.assertTrue(ingest_emojis([FileStorage(io.BytesIO(gif.getvalue()), 'spin.gif')])[0].saved)
+        emoji = Emoji.query.filter(Emoji.file_path.like('%.gif')).first()
+        for path in (emoji.small_path, emoji.small_webp_path):
+            small = Image.open(os.path.join(static_dir, path))
+            self.assertEqual((small.size, small.n_frames), ((35, 35), 3))
+        with self.app.test_request_context(headers={'Accept': 'image/webp,*/*'}):
+            self.assertEqual(small_image(emoji.small_path, emoji.small_webp_path), emoji.small_webp_path)
+        with self.app.test_request_context(headers={'Accept': '*/*'}):
+            self.assertEqual(small_image(emoji.small_path, emoji.small_webp_path), emoji.small_path)
+
+    def test_emoji_sprites(self):
+        self.app.config['IMAGE_STORE_FOLDER'] = tempfile.mkdtemp()
+        emoji_sprites.folder = tempfile.mkdtemp()
+
+        def image(colour, animated=False):
+            data = io.BytesIO()
+            frames = [Image.new('RGB', (50, 50), c) for c in (colour, 'white')]
+            frames[0].save(data, 'GIF' if animated else 'PNG', save_all=animated, append_images=frames[1:])
+            return FileStorage(io.BytesIO(data.getvalue()), 'emoji.gif' if animated else 'emoji.png')
+
+        ingest_emojis([image('red'), image('green'), image('blue', animated=True)])
+        red, green, blue = Emoji.query.order_by(Emoji.id).all()
+        self.assertEqual(emoji_sprites.sprite_class(red.small_path), 'emoji-sprite emoji-sprite-0')
+        self.assertEqual(emoji_sprites.sprite_class(green.small_path), 'emoji-sprite emoji-sprite-1')
+        self.assertIsNone(emoji_sprites.sprite_class(blue.small_path))
+        sheet = Image.open(os.path.join(emoji_sprites.folder, emoji_sprites.read_map()['sheets'][0])).convert('RGB')
+        self.assertEqual((sheet.getpixel((17, 17)), sheet.getpixel((35 + 17, 17))), ((255, 0, 0), (0, 128, 0)))
+
+        # emojis keep their slot, and freed ones are reused
+        db.session.delete(red)
+        db.session.commit()
+        ingest_emojis([image('yellow')])
+        yellow = Emoji.query.order_by(Emoji.id.desc()).first()
+        self.assertEqual(emoji_sprites.sprite_class(green.small_path), 'emoji-sprite emoji-sprite-1')
+        self.assertEqual(emoji_sprites.sprite_class(yellow.small_path), 'emoji-sprite emoji-sprite-0')
+        with open(os.path.join(emoji_sprites.folder, emoji_sprites.stylesheet)) as f:
+            self.assertIn('.emoji-sprite-1 {', f.read())
+
+        # pages only read the map, at most once per request, so a build by another worker shows up with the next one
+        yellow_path = yellow.small_path
+        db.session.delete(yellow)
+        db.session.commit()
+        other_worker = EmojiSprites()
+        other_worker.folder, other_worker.static_folder = emoji_sprites.folder, emoji_sprites.static_folder
+        # (g belongs to the app context, which each request has its own of outside the tests)
+        with self.app.app_context(), self.app.test_request_context():
+            self.assertEqual(emoji_sprites.sprite_class(yellow_path), 'emoji-sprite emoji-sprite-0')
+            other_worker.rebuild()
+            self.assertEqual(emoji_sprites.sprite_class(yellow_path), 'emoji-sprite emoji-sprite-0')
+        with self.app.app_context(), self.app.test_request_context():
+            self.assertIsNone(emoji_sprites.sprite_class(yellow_path))
+
+
+class MelonMarkupCase(unittest.TestCase):
+    def test_simple_tags(self):
+        self.assertEqual(melon_markup.parse("[b]bold[/b] and [i]italics[/i]"),
+                         "<strong>bold</strong> and <em>italics</em>")
+        self.assertEqual(melon_markup.parse("[b][b]x[/b][/b]"), "<strong><strong>x</strong></strong>")
+
+    def test_escaping(self):
+        self.assertEqual(melon_markup.parse("a < b & c\nd"), "a &lt; b &amp; c<br/>d")
+
+    def test_unmatched_tags(self):
+        self.assertEqual(melon_markup.parse("[b]never closed"), "[b]never closed")
+        self.assertEqual(melon_markup.parse("[/b] [zz]"), "[/b] [zz]")
+
+    def test_crossed_tags(self):
+        self.assertEqual(melon_markup.parse("[b]x[i]y[/b]z[/i]"), "<strong>x<em>y</strong>z</em>")
+
+    def test_quote(self):
+        self.assertEqual(melon_markup.parse("[quote,name=bob]hi[/quote]"),
+                         '<blockquote><footer class="blockquote-footer"><cite>bob</cite></footer>'
+                         '<p class="mb-0">hi</p></blockquote>')
+
+
+class MarkupRerenderCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_markup_rerender(self):
+        cli.register(self.app)
+        posts = [Post(body='[b]one[/b]'), Post(body='[quote,name=bob,post_id=1]two[/quote]'), Post(body='[i]three[/i]')]
+        with self.app.test_request_context():  # quote links are built with url_for
+            db.session.add_all(posts)
+            db.session.commit()
+        ids = [p.id for p in posts]
+        versions = [p.version for p in posts]
+        Post.query.filter(Post.id != ids[2]).update({'markup_version': None, 'body_formatted': None},
+                                                         synchronize_session=False)
+        Post.query.filter_by(id=ids[2]).update({'body_formatted': 'current'}, synchronize_session=False)
+        db.session.commit()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['markup', 'rerender', '--workers', '1', '--table', 'post'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        # the command's app context removes the session, so the posts are loaded again
+        posts = [Post.query.get(i) for i in ids]
+        self.assertEqual(posts[0].body_formatted, melon_markup.parse('[b]one[/b]'))
+        self.assertIn('<a href=/post/1>bob</a>', posts[1].body_formatted)
+        self.assertEqual([p.markup_version for p in posts], [melon_markup.VERSION] * 3)
+        self.assertEqual([p.version for p in posts], [versions[0] + 1, versions[1] + 1, versions[2]])
+        self.assertEqual(posts[2].body_formatted, 'current')  # already up to date
+
+        # --all renders rows that are up to date too, from --start-id on, in worker processes
+        result = runner.invoke(args=['markup', 'rerender', '--workers', '2', '--table', 'post', '--all',
+                                     '--start-id', str(ids[0])])
+        self.assertEqual(result.exit_code, 0, result.output)
+        posts = [Post.query.get(i) for i in ids]
+        self.assertEqual(posts[2].body_formatted, melon_markup.parse('[i]three[/i]'))
+        self.assertIn('<a href=/post/1>bob</a>', posts[1].body_formatted)
+        self.assertEqual([p.version for p in posts], [versions[0] + 1, versions[1] + 2, versions[2] + 1])
+
+
+class DonutCatalogCase(unittest.TestCase):
+    def test_donut_catalog(self):
+        folder = tempfile.mkdtemp()
+        for name in ('a.svg', 'b.svg', 'c.svg', 'license.txt'):
+            open(os.path.join(folder, name), 'w').close()
+        catalog = DonutCatalog(folder, os.path.dirname(folder), check_interval=0)
+        prefix = os.path.basename(folder) + '/'
+        self.assertEqual(catalog.all(), [prefix + 'a.svg', prefix + 'b.svg', prefix + 'c.svg'])
+        self.assertEqual({catalog.choose(42) for _ in range(10)}, {catalog.choose(42)})
+
+        os.remove(os.path.join(folder, 'b.svg'))
+        os.utime(folder, ns=(0, 0))  # make sure the mtime changes however coarse the filesystem's clock is
+        self.assertEqual(catalog.all(), [prefix + 'a.svg', prefix + 'c.svg'])
+
+
+class SQLProfilerCase(unittest.TestCase):
+    def test_repeated_statements(self):
+        profile = RequestProfile(slowest=2)
+        profile.record('SELECT * FROM post WHERE post.id IN (?, ?)', 0.003)
+        for i in range(5):
+            profile.record('SELECT * FROM user\nWHERE user.id = ?', 0.001 * i)
+        profile.record('SELECT * FROM post WHERE post.id IN (?, ?, ?)', 0.002)
+
+        self.assertEqual(profile.count, 7)
+        self.assertAlmostEqual(profile.duration, 0.015)
+        self.assertEqual([duration for duration, statement in profile.slowest], [0.004, 0.003])
+        self.assertEqual(profile.repeated(5), [('SELECT * FROM user WHERE user.id = ?', 5)])
+        self.assertEqual(profile.repeated(2)[1], ('SELECT * FROM post WHERE post.id IN (?)', 2))
+
+    def test_profiled_request(self):
+        app = create_app(ProfiledConfig)
+        app.config['SQL_PROFILE_SERVER_TIMING'] = True
+        profiles = profile_requests(app)
+
+        @app.route('/lazy_loads')
+        def lazy_loads():
+            for i in range(app.config['SQL_PROFILE_REPEAT_THRESHOLD']):
+                User.query.get(i)
+            return ''
+
+        with app.app_context():
+            db.create_all()
+            with self.assertLogs(app.logger) as logs:
+                response = app.test_client().get('/lazy_loads')
+            db.drop_all()
+        profile, = profiles
+        self.assertEqual(profile.count, app.config['SQL_PROFILE_REPEAT_THRESHOLD'])
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        self.assertIn('{} queries'.format(profile.count), response.headers['Server-Timing'])
+        info, warning = logs.records
+        self.assertIn('GET /lazy_loads: {} queries'.format(profile.count), info.getMessage())
+        self.assertIn('probable N+1', warning.getMessage())
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lru_backend(self):
+        backend = LRUBackend(2)
+        backend.set('a', '1')
+        backend.set('b', '2')
+        self.assertEqual(backend.get('a'), '1')
+        backend.set('c', '3')  # b is the least recently used now
+        self.assertEqual([backend.get(key) for key in 'abc'], ['1', None, '3'])
+
+    def test_cached_fragment(self):
+        cache = FragmentCache(self.app)
+        with self.app.test_request_context():
+            first = cache.cached_fragment('author:1:x', '_post_author.html', author=User(id=1, username='susan'))
+            again = cache.cached_fragment('author:1:x', '_post_author.html', author=User(id=1, username='mary'))
+            changed = cache.cached_fragment('author:1:y', '_post_author.html', author=User(id=1, username='mary'))
+        self.assertIn('susan', first)
+        self.assertEqual(first, again)
+        self.assertIn('mary', changed)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_keys_change_with_templates(self):
+        folder = tempfile.mkdtemp()
+        with open(os.path.join(folder, '_fragment.html'), 'w') as f:
+            f.write('<p>{{ value }}</p>')
+        app = Flask(__name__, template_folder=folder)
+        before = templates_digest(app)
+        self.assertEqual(templates_digest(app), before)
+        with open(os.path.join(folder, '_fragment.html'), 'w') as f:
+            f.write('<picture>{{ value }}</picture>')
+        self.assertNotEqual(templates_digest(app), before)
+        self.assertTrue(FragmentCache(self.app).prefix.startswith(templates_digest(self.app)))
+
+    def test_thread_page_fragments(self):
+        u = User(username='john', email='john@example.com')
+        t = Thread(title='thread')
+        db.session.add_all([u, t])
+        db.session.commit()
+        p1, p2 = Post(body='first', thread=t, author=u), Post(body='second', thread=t, author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        client = self.app.test_client()
+        log_in(client, u)
+        url = '/thread/{}?page=1'.format(t.id)
+
+        client.get(url)
+        misses = fragment_cache.misses
+        self.assertIn('second', client.get(url).get_data(as_text=True))
+        self.assertEqual(fragment_cache.misses, misses)
+
+        # editing a post only renders that post's content again
+        p2.edit('second, edited', u)
+        self.assertIn('second, edited', client.get(url).get_data(as_text=True))
+        self.assertEqual(fragment_cache.misses, misses + 1)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_access(self):
+        john = User(username='john', email='john@example.com', mod_level=1)
+        susan = User(username='susan', email='susan@example.com', mod_level=self.app.config['METRICS_MOD_LEVEL'])
+        db.session.add_all([john, susan])
+        db.session.commit()
+        client = self.app.test_client()
+        remote = {'REMOTE_ADDR': '203.0.113.7'}
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        self.assertEqual(client.get('/metrics', environ_base=remote).status_code, 404)
+        log_in(client, john)
+        self.assertEqual(client.get('/metrics', environ_base=remote).status_code, 404)
+        log_in(client, susan)
+        self.assertEqual(client.get('/metrics', environ_base=remote).status_code, 200)
+
+    def test_request_metrics(self):
+        u = User(username='john', email='john@example.com')
+        t = Thread(title='thread')
+        db.session.add_all([u, t])
+        db.session.commit()
+        db.session.add(Post(body='post', thread=t, author=u))
+        db.session.commit()
+        client = self.app.test_client()
+        log_in(client, u)
+        labels = {'endpoint': 'main.thread', 'method': 'GET', 'status': '200'}
+        requests = REGISTRY.get_sample_value('melly_request_duration_seconds_count', labels) or 0
+        renders = REGISTRY.get_sample_value('melly_markup_renders_total') or 0
+
+        self.assertEqual(client.get('/thread/{}?page=1'.format(t.id)).status_code, 200)
+        Post(body='[b]post[/b]').format()
+        self.assertEqual(REGISTRY.get_sample_value('melly_request_duration_seconds_count', labels), requests + 1)
+        self.assertEqual(REGISTRY.get_sample_value('melly_requests_in_flight', {'endpoint': 'main.thread'}), 0)
+        self.assertEqual(REGISTRY.get_sample_value('melly_markup_renders_total'), renders + 1)
+
+        output = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('melly_request_duration_seconds_count{endpoint="main.thread",method="GET",status="200"} ',
+                      output)
+        queries = re.search(r'^melly_request_db_queries_sum\{endpoint="main.thread"\} (\S+)$', output, re.M)
+        self.assertGreater(float(queries.group(1)), 0)
+        self.assertIn('melly_request_db_seconds_count{endpoint="main.thread"} ', output)
+        self.assertIn('melly_markup_renders_total ', output)
+
+    def test_multiprocess_metrics(self):
+        # with PROMETHEUS_MULTIPROC_DIR set, values go to files there and /metrics adds those up, not this process's
+        folder = tempfile.mkdtemp()
+        client = self.app.test_client()
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': folder}), \
+                mock.patch('prometheus_client.values.ValueClass', values.MultiProcessValue()):
+            try:
+                self.assertEqual(client.open('/no-such-page', method='PATCH').status_code, 404)
+                output = client.get('/metrics').get_data(as_text=True)
+            finally:
+                # so that the rest of the tests don't write to the folder
+                REQUEST_LATENCY.remove('none', 'PATCH', '404')
+                for metric in (REQUESTS_IN_FLIGHT, DB_QUERIES, DB_TIME):
+                    metric.remove('none')
+        self.assertTrue(os.listdir(folder))
+        self.assertIn('melly_request_duration_seconds_count{endpoint="none",method="PATCH",status="404"} 1.0', output)
+        self.assertNotIn('endpoint="main.', output)
+
+
+class RecordingSearch(object):
+    def __init__(self, down=False):
+        self.down = down
+        self.bulks = []
+
+    def bulk(self, body, request_timeout=None):
+        if self.down:
+            raise SearchConnectionError('N/A', 'down', None)
+        self.bulks.append(body)
+        return {'errors': False, 'items': []}
+
+    def search(self, **kwargs):
+        if self.down:
+            raise SearchConnectionError('N/A', 'down', None)
+        return {'hits': {'hits': [], 'total': 0}}
+
+
+class SearchOutboxCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_changes_are_queued_and_coalesced(self):
+        self.app.search_backend = ElasticsearchBackend(RecordingSearch())
+        p = Post(body='first')
+        kept = Post(body='kept')
+        db.session.add_all([p, kept])
+        db.session.commit()
+        p.body = 'edited'
+        db.session.commit()
+        kept.seq = 5  # not a searchable column
+        db.session.commit()
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(SearchOutbox.query.count(), 4)
+
+        self.assertEqual(search_outbox.flush(), 4)
+        self.assertEqual(SearchOutbox.query.count(), 0)
+        body, = self.app.search_backend.client.bulks
+        self.assertEqual(body, [{'delete': {'_index': 'post', '_type': 'post', '_id': p.id}},
+                                {'index': {'_index': 'post', '_type': 'post', '_id': kept.id}}, {'body': 'kept'}])
+
+    def test_flusher_starts_with_the_first_request(self):
+        client = self.app.test_client()
+        with mock.patch.object(search_outbox, 'flush_interval', 5), \
+                mock.patch.object(search_outbox, 'start_flusher') as start_flusher:
+            client.get('/auth/login')
+            start_flusher.assert_called_once_with()
+            # once it is running later requests leave it alone
+            search_outbox.flusher = mock.Mock()
+            try:
+                client.get('/auth/login')
+            finally:
+                search_outbox.flusher = None
+            start_flusher.assert_called_once_with()
+
+    def test_breaker_opens_after_failures(self):
+        self.app.search_backend = ElasticsearchBackend(RecordingSearch(down=True))
+        db.session.add(Post(body='queued'))
+        db.session.commit()
+        for _ in range(self.app.config['SEARCH_BREAKER_THRESHOLD']):
+            with self.assertRaises(SearchConnectionError):
+                search_outbox.flush()
+        self.assertTrue(search_outbox.breaker.is_open)
+        # nothing is called while it is open, and the change stays queued
+        self.app.search_backend.client.down = False
+        self.assertEqual(search_outbox.flush(), 0)
+        self.assertEqual(Post.search('queued', 1, 10)[1], 0)
+        self.assertEqual(SearchOutbox.query.count(), 1)
+
+    def test_sqlite_backend(self):
+        posts = [Post(body='the cat sat on the mat'), Post(body='cats and more cats, nothing but cats'),
+                 Post(body='a dog'), Post(body='gone cat')]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.delete(posts[3])
+        posts[2].body = 'a dog and a cat'
+        db.session.commit()
+        search_outbox.flush()
+
+        # stemmed, best match first, and deleted posts are gone
+        found, total = Post.search('Cat', 1, 10)
+        self.assertEqual(total, 3)
+        self.assertEqual(found.all()[0], posts[1])
+        self.assertEqual(Post.search('dog cat', 1, 10)[0].all(), [posts[2]])
+        self.assertEqual(Post.search('"mat" (cat*', 1, 10)[1], 1)  # not FTS5 syntax
+        page, total = Post.search('cat', 2, 2)
+        self.assertEqual((len(page.all()), total), (1, 3))
+
+        reset_index('post')
+        self.assertEqual(Post.search('cat', 1, 10)[1], 0)
+        Post.reindex()
+        self.assertEqual(Post.search('cat', 1, 10)[1], 3)
+
+        # common words still have to match, but don't count towards the ranking
+        self.app.search_backend.common_hits = 2
+        search_cache.clear()
+        self.assertEqual(Post.search('cat', 1, 10)[0].all(), [posts[2], posts[1], posts[0]])
+        self.assertEqual(Post.search('mat cat', 1, 10)[0].all(), [posts[0]])
+
+    def test_search_results(self):
+        t = Thread(title='long')
+        db.session.add(t)
+        db.session.commit()
+        for i in range(30):
+            db.session.add(Post(body='filler {}'.format(i), thread=t))
+            db.session.commit()
+        db.session.add(Post(body='<b>[i]rare[/i]</b> find', thread=t))
+        db.session.commit()
+        search_outbox.flush()
+
+        (result,), total = Post.search_results('RARE', 1, 10)
+        self.assertEqual((total, result.thread, result.page), (1, t, 2))
+        self.assertEqual(str(result.snippet), '&lt;b&gt;<mark>rare</mark>&lt;/b&gt; find')
+        with self.app.test_request_context():  # quote links are built with url_for
+            db.session.add(Post(body='[quote,name=bob,post_id=1]quoted[/quote][quote, name=amy]rare[/quote] reply',
+                                thread=t))
+            db.session.commit()
+        search_outbox.flush()
+        (result,), total = Post.search_results('reply', 1, 10)
+        self.assertEqual(str(result.snippet), 'quotedrare <mark>reply</mark>')
+
+        # pages of the same search come from one request to the backend
+        misses = search_cache.misses
+        second = Post.search_results('filler', 2, 4)[0]
+        third = Post.search_results('filler', 3, 4)[0]
+        self.assertEqual(len({r.post for r in second + third}), 8)
+        self.assertEqual(search_cache.misses, misses + 1)
+
+        # sending changes to the index drops the cached results
+        db.session.add(Post(body='filler again', thread=t))
+        db.session.commit()
+        search_outbox.flush()
+        self.assertEqual(Post.search_results('filler', 1, 4)[1], 31)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file